@@ -0,0 +1,77 @@
+import numpy as np
+from skimage.morphology import skeletonize
+from tools import clean_background, resize_image
+from rectification import find_homography, apply_homography, warped_landmarks
+from classification import group, classify_lines, get_cluster_centers, scale_lines
+from measurement import measure_image
+from metrics import stage
+
+#########################################################################################
+# Artifacts of the pipeline as a dependency graph                                       #
+# each named artifact is computed from its dependencies on first request and memoized  #
+# for the request, so only the stages leading to the requested artifacts ever run      #
+#########################################################################################
+
+# name -> (dependencies, function of the PalmReader and the dependency values)
+ARTIFACTS = {
+    'palm_without_background': (['image'], lambda reader, image: clean_background(image)),
+    'homography': (['image'], lambda reader, image: find_homography(image, reader.hands)),
+    'M': (['homography'], lambda reader, homography: homography[0]),
+    'landmarks': (['homography'], lambda reader, homography: homography[1]),
+    'warped': (['image', 'M'], lambda reader, image, M: apply_homography(image, M)),
+    'warped_mini': (['warped'], lambda reader, warped: resize_image(warped, reader.resize_value)),
+    'warped_clean': (['warped'], lambda reader, warped: clean_background(warped)),
+    'warped_clean_mini': (['warped_clean'], lambda reader, warped_clean: resize_image(warped_clean, reader.resize_value)),
+    'palmline_img': (['warped_clean'], lambda reader, warped_clean: reader.detect([warped_clean])[0]),
+    'skeleton': (['palmline_img'], lambda reader, palmline_img: (skeletonize(palmline_img > 0) * 255).astype(np.uint8)),
+    'candidates': (['skeleton'], lambda reader, skeleton: group(skeleton)),
+    'lines': (['candidates', 'palmline_img'], lambda reader, candidates, palmline_img: classify_lines(get_cluster_centers(), candidates, palmline_img.shape[0], palmline_img.shape[1])),
+    'mini_lines': (['lines', 'palmline_img'], lambda reader, lines, palmline_img: scale_lines(lines, palmline_img.shape[0], reader.resize_value)),
+    'mini_landmarks': (['M', 'landmarks', 'warped'], lambda reader, M, landmarks, warped: warped_landmarks(M, landmarks, warped.shape[1], warped.shape[0])),
+    'measurement': (['warped_mini', 'mini_lines', 'mini_landmarks'], lambda reader, warped_mini, lines, landmarks: measure_image(warped_mini, lines, reader.hands, landmarks)),
+    'im': (['measurement'], lambda reader, measurement: measurement[0]),
+    'contents': (['measurement'], lambda reader, measurement: measurement[1]),
+}
+
+# file names of the artifacts that can be saved as images (the result is saved by save_result)
+ARTIFACT_FILES = {
+    'palm_without_background': 'palm_without_background.jpg',
+    'warped': 'warped_palm.jpg',
+    'warped_mini': 'warped_palm_mini.jpg',
+    'warped_clean': 'warped_palm_clean.jpg',
+    'warped_clean_mini': 'warped_palm_clean_mini.jpg',
+    'palmline_img': 'palm_lines.png',
+    'skeleton': 'palm_skeleton.png',
+}
+
+class PalmArtifacts:
+    """Artifacts of one input image, see ARTIFACTS
+
+    an artifact is None when one of its dependencies is None (e.g. every artifact of the warped palm
+    when no hand was found)
+    """
+
+    # reader : PalmReader providing the session (Hands context, UNet, resize_value)
+    # image : BGR array of the input palm
+    def __init__(self, reader, image):
+        self.reader = reader
+        self.values = {'image': image}
+
+    def get(self, name):
+        if name not in self.values:
+            dependencies, compute = ARTIFACTS[name]
+            args = [self.get(dependency) for dependency in dependencies]
+            if any(arg is None for arg in args):
+                self.values[name] = None
+            else:
+                with stage(name):
+                    self.values[name] = compute(self.reader, *args)
+        return self.values[name]
+
+    # set an artifact computed elsewhere (batched detection, cache)
+    def put(self, name, value):
+        self.values[name] = value
+
+    # artifact if it was already computed, None otherwise
+    def computed(self, name):
+        return self.values.get(name)
@@ -0,0 +1,146 @@
+import os
+import copy
+import glob
+import tempfile
+import time
+import argparse
+import numpy as np
+import cv2
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from model import *
+
+# CPU inference backends for the palm line UNet
+# eager       : the checkpoint as is (fp32 reference)
+# fused       : BatchNorm folded into the preceding convolutions
+# torchscript : fused, traced and frozen TorchScript graph
+# compile     : fused, compiled with torch.compile
+# bf16        : fused, run under bfloat16 autocast
+# int8        : static int8 quantization (FX graph mode), calibrated on sample palms
+# onnx        : exported to ONNX (see onnx_export.py) and run with ONNX Runtime
+BACKENDS = ['eager', 'fused', 'torchscript', 'compile', 'bf16', 'int8', 'onnx']
+
+# fold every Conv2d + BatchNorm2d pair of DoubleConv blocks, returns a new net in eval mode
+def fold_batchnorm(net):
+    net = copy.deepcopy(net).eval()
+    for module in net.modules():
+        if isinstance(module, DoubleConv):
+            layers = module.double_conv
+            for i in [0, 3]:
+                layers[i] = fuse_conv_bn_eval(layers[i], layers[i + 1])
+                layers[i + 1] = nn.Identity()
+    return net
+
+class Bf16Net(nn.Module):
+    """Runs the wrapped net under bfloat16 autocast, logits are returned as float32"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.net(x).float()
+
+# int8 static quantization, calibration is a list of (3,H,W) float32 arrays from detection.preprocess
+def quantize_int8(net, calibration):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    batch = torch.from_numpy(np.stack(calibration))
+    prepared = prepare_fx(copy.deepcopy(net).eval(), get_default_qconfig_mapping('x86'), (batch[:1],))
+    with torch.inference_mode():
+        for img in batch:
+            prepared(img.unsqueeze(0))
+    return convert_fx(prepared)
+
+# build the inference net for a backend from a loaded (fp32, eval) UNet
+# resize_value : input size used to trace the torchscript graph
+# calibration : sample inputs, required for int8
+def prepare_backend(net, backend='eager', resize_value=256, calibration=None):
+    if backend not in BACKENDS:
+        raise ValueError('unknown backend {} (choose from {})'.format(backend, ', '.join(BACKENDS)))
+    net = net.eval()
+    if backend == 'eager':
+        return net
+    if backend == 'int8':
+        if not calibration:
+            raise ValueError('int8 backend needs calibration images')
+        return quantize_int8(net, calibration)
+    if backend == 'onnx':
+        from onnx_export import export_onnx
+        from onnx_net import OnnxNet
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_onnx(net, os.path.join(tmp_dir, 'unet.onnx'), resize_value)
+            return OnnxNet(os.path.join(tmp_dir, 'unet.onnx'))
+
+    net = fold_batchnorm(net)
+    if backend == 'torchscript':
+        with torch.inference_mode():
+            traced = torch.jit.trace(net, torch.zeros((1, 3, resize_value, resize_value)))
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if backend == 'compile':
+        return torch.compile(net)
+    if backend == 'bf16':
+        return Bf16Net(net)
+    return net
+
+# intersection over union of two line masks
+def mask_iou(mask_a, mask_b):
+    a, b = mask_a > 0, mask_b > 0
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / union
+
+# rectified, background-removed sample palms as network inputs
+def load_samples(image_paths, resize_value):
+    from tools import load_image, clean_background
+    from rectification import warp_palm, create_hands
+    from detection import preprocess
+
+    samples = []
+    with create_hands() as hands:
+        for path in image_paths:
+            warped = warp_palm(load_image(path), hands)
+            if warped is None:
+                print('skip {} (palm not detected)'.format(path))
+                continue
+            samples.append(preprocess(cv2.cvtColor(clean_background(warped), cv2.COLOR_BGR2RGB), resize_value))
+    return samples
+
+# report latency and mask IoU against the fp32 reference for each backend
+def compare_backends(net, samples, backends, resize_value, repeat=5):
+    from detection import detect_batch
+
+    reference = detect_batch(net, samples)
+    print('{:<12} {:>12} {:>10} {:>10}'.format('backend', 'latency(ms)', 'mean IoU', 'min IoU'))
+    for backend in backends:
+        try:
+            backend_net = prepare_backend(net, backend, resize_value, samples)
+            detect_batch(backend_net, samples[:1])  # warm up
+        except Exception as e:
+            print('{:<12} failed: {}'.format(backend, e))
+            continue
+        latencies = []
+        for _ in range(repeat):
+            for sample in samples:
+                start = time.perf_counter()
+                detect_batch(backend_net, [sample])
+                latencies.append(time.perf_counter() - start)
+        ious = [mask_iou(a, b) for a, b in zip(reference, detect_batch(backend_net, samples))]
+        print('{:<12} {:>12.1f} {:>10.4f} {:>10.4f}'.format(backend, np.median(latencies) * 1000, np.mean(ious), np.min(ious)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare UNet inference backends against the fp32 reference')
+    parser.add_argument('--images', nargs='+', default=glob.glob('input/*.jpg'), help='sample palm images')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--resize_value', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    net = load_unet(args.model)
+    samples = load_samples(args.images, args.resize_value)
+    compare_backends(net.eval(), samples, args.backends, args.resize_value, args.repeat)
@@ -0,0 +1,93 @@
+import os
+import sys
+import glob
+import json
+import time
+import multiprocessing
+from contextlib import nullcontext
+from palm_reader import *
+from metrics import tracing
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.heic', '.HEIC', '.JPG', '.JPEG', '.PNG']
+
+# reader of the current worker process, created once by init_worker
+reader = None
+# add the stage timings and counters of each image to its record (see metrics.py)
+trace_images = False
+
+def init_worker(path_to_model, resize_value, backend, num_threads, cache_dir, trace=False, result_format='jpg', saved=SAVED_ARTIFACTS, detect_size=None, memory_limit=TILE_MEMORY_LIMIT):
+    global reader, trace_images
+    trace_images = trace
+    cache = ResultCache(cache_dir=cache_dir) if cache_dir is not None else None
+    reader = PalmReader(PalmSession(path_to_model, resize_value, backend=backend, detect_size=detect_size, memory_limit=memory_limit, num_threads=num_threads), cache, result_format, saved)
+
+# read one image in a worker, returns a JSON-serializable record
+def read_one(task):
+    path_to_image, results_dir = task
+    start = time.perf_counter()
+    trace = None
+    try:
+        with tracing() if trace_images else nullcontext() as trace, open(path_to_image, 'rb') as f:
+            result = reader.read_bytes(f.read(), results_dir)
+    except Exception as e:
+        record = {'status': 'error', 'error': repr(e)}
+    else:
+        if result is None:
+            record = {'status': 'not_detected'}
+        else:
+            record = dict(status='ok', results_dir=results_dir, **result_to_dict(result))
+    record['input'] = path_to_image
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    if trace is not None:
+        record['trace'] = trace.to_dict()
+    return record
+
+# list the images of a directory (recursively) or of a manifest file (one path per line)
+def list_images(input_dir=None, manifest=None):
+    if manifest is not None:
+        with open(manifest, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    paths = glob.glob(os.path.join(input_dir, '**', '*'), recursive=True)
+    return sorted(path for path in paths if os.path.splitext(path)[1] in IMAGE_EXTENSIONS)
+
+# output directory of each image : its path relative to the inputs' common root, with the extension
+# kept as a suffix (photos/a.jpg -> photos/a_jpg) so a.jpg and a.png don't share a directory
+def output_dirs(paths, output_dir):
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    dirs = []
+    for path in paths:
+        name, extension = os.path.splitext(os.path.relpath(os.path.abspath(path), root))
+        dirs.append(os.path.join(output_dir, name + extension.replace('.', '_')))
+    return dirs
+
+# read all images on a process pool, each worker loads the model once
+# records are appended to path_to_jsonl as soon as each image is done
+# saved : artifacts of each image written under output_dir (see artifacts.ARTIFACT_FILES), [] = records only
+# cache_dir : on-disk result cache shared by the workers, so re-submitted images are not processed again
+# trace : add the per-stage timings and counters of each image to its record
+# result_format : format of each saved result, see render.FORMATS
+# detect_size, memory_limit : tiled line detection in each worker, see session.PalmSession
+def read_batch(paths, output_dir, path_to_jsonl, workers=None, path_to_model='checkpoint/checkpoint_aug_epoch70.pth', resize_value=256, backend='eager', saved=SAVED_ARTIFACTS, cache_dir=None, trace=False, result_format='jpg',
+               detect_size=None, memory_limit=TILE_MEMORY_LIMIT):
+    if not paths:
+        print('no image to read, nothing to do')
+        return
+    workers = workers or os.cpu_count()
+    num_threads = max(1, os.cpu_count() // workers)
+    dirs = output_dirs(paths, output_dir) if saved else [None] * len(paths)
+    os.makedirs(os.path.dirname(os.path.abspath(path_to_jsonl)), exist_ok=True)
+
+    start = time.perf_counter()
+    num_done = 0
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, init_worker, (path_to_model, resize_value, backend, num_threads, cache_dir, trace, result_format, saved, detect_size, memory_limit)) as pool, \
+            open(path_to_jsonl, 'a', encoding='utf-8') as f:
+        for record in pool.imap_unordered(read_one, zip(paths, dirs)):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            num_done += 1
+            elapsed = time.perf_counter() - start
+            print('[{}/{}] {} {} ({:.2f} images/sec)'.format(num_done, len(paths), record['status'], record['input'], num_done / elapsed), file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print('{} images in {:.1f}s, {:.2f} images/sec with {} workers'.format(num_done, elapsed, num_done / max(elapsed, 1e-9), workers))
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+import numpy as np
+import cv2
+from skimage.morphology import skeletonize
+from tools import *
+from rectification import *
+from detection import *
+from classification import *
+from measurement import *
+from session import PalmSession
+from metrics import tracing
+
+#########################################################################################
+# Per-stage benchmark                                                                   #
+# - times every stage of the pipeline on a sample palm (median / p95 latency)           #
+# - times skeleton grouping on synthetic skeletons with a controlled number of          #
+#   junctions, to stress the line enumeration (uncapped, with the number of paths)      #
+# - reports the peak Python memory of each stage (tracemalloc, measured in a separate   #
+#   run so it doesn't slow down the timed runs) and the peak RSS of the process         #
+# - compares medians and memory peaks to a stored baseline, exits with 1 on regressions #
+#########################################################################################
+
+# synthetic skeleton with about num_junctions crossings : a grid of slightly tilted lines
+def synthetic_skeleton(num_junctions, size=256):
+    rows = max(1, int(np.ceil(np.sqrt(num_junctions))))
+    cols = max(1, int(np.ceil(num_junctions / rows)))
+    img = np.zeros((size, size), dtype=np.uint8)
+    margin = size // 8
+    for i in range(rows):
+        y = margin + (size - 2 * margin) * (i + 0.5) / rows
+        cv2.line(img, (margin // 2, int(y)), (size - margin // 2, int(y + margin // 4)), 255, 1)
+    for j in range(cols):
+        x = margin + (size - 2 * margin) * (j + 0.5) / cols
+        cv2.line(img, (int(x), margin // 2), (int(x + margin // 4), size - margin // 2), 255, 1)
+    return (skeletonize(img > 0) * 255).astype(np.uint8)
+
+# run fn repeat times, returns the list of durations in seconds
+def time_runs(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+# peak Python memory allocated by one run of fn, in bytes
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# stage name -> function of the pipeline on one palm, each using the output of the previous stages
+def pipeline_stages(session, image, path_to_result):
+    state = {}
+    resize_value = session.resize_value
+
+    def warp():
+        rectified = rectify_palm(image, session.hands)
+        if rectified is None:
+            raise RuntimeError('palm not detected in the benchmark image')
+        state['warped'], state['M'], state['landmarks'] = rectified
+
+    def do_resize():
+        state['warped_mini'] = resize_image(state['warped'], resize_value)
+
+    def detect():
+        img = preprocess(cv2.cvtColor(clean_background(state['warped']), cv2.COLOR_BGR2RGB), session.detect_size)
+        state['palmline_img'] = session.detect([img])[0]
+
+    def skeleton_group():
+        skel_img = (skeletonize(state['palmline_img'] > 0) * 255).astype(np.uint8)
+        state['candidates'] = group(skel_img)
+
+    def choose_lines():
+        state['lines'] = classify_lines(get_cluster_centers(), state['candidates'], session.detect_size, session.detect_size)
+
+    def measure():
+        warped = state['warped']
+        landmarks = warped_landmarks(state['M'], state['landmarks'], warped.shape[1], warped.shape[0])
+        state['im'], state['contents'] = measure_image(state['warped_mini'], scale_lines(state['lines'], session.detect_size, resize_value), session.hands, landmarks)
+
+    def save():
+        save_result(state['im'], state['contents'], resize_value, path_to_result)
+
+    return [('remove_background', lambda: clean_background(image)),
+            ('warp_image', warp),
+            ('resize', do_resize),
+            ('detect', detect),
+            ('skeletonize+group', skeleton_group),
+            ('classify_lines', choose_lines),
+            ('measure', measure),
+            ('save_result', save)]
+
+def summarize(durations, peak):
+    return {'median_ms': float(np.median(durations) * 1000),
+            'p95_ms': float(np.percentile(durations, 95) * 1000),
+            'peak_kb': peak / 1024}
+
+def run_benchmark(session, path_to_image, junction_counts, repeat, path_to_result):
+    results = {}
+    image = load_image(path_to_image)
+    for name, fn in pipeline_stages(session, image, path_to_result):
+        fn()  # warm up, and the output is needed by the next stages
+        results[name] = summarize(time_runs(fn, repeat), peak_memory(fn))
+
+    # the whole enumeration is timed (no path cap, no time limit), so keep the junction counts small :
+    # the number of paths grows exponentially with them
+    for num_junctions in junction_counts:
+        skel_img = synthetic_skeleton(num_junctions, session.resize_value)
+        fn = lambda: group(skel_img, max_paths=None, time_limit=None)
+        with tracing() as trace:
+            fn()
+        results['group[{} junctions]'.format(num_junctions)] = dict(summarize(time_runs(fn, repeat), peak_memory(fn)),
+                                                                   paths=trace.counters.get('paths_explored', 0))
+    return results
+
+# (stage, metric, baseline, current) of the stage medians (median_ms) and memory peaks (peak_kb)
+# that grew by more than threshold / memory_threshold (relative) over the baseline
+def find_regressions(results, baseline, threshold, memory_threshold):
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for metric, allowed in [('median_ms', threshold), ('peak_kb', memory_threshold)]:
+            base = baseline[name].get(metric)
+            if base is not None and stats[metric] > base * (1 + allowed):
+                regressions.append((name, metric, base, stats[metric]))
+    return regressions
+
+def print_results(results, baseline=None):
+    print('{:<24} {:>11} {:>11} {:>11} {:>9} {:>11} {:>13}'.format('stage', 'median(ms)', 'p95(ms)', 'peak(KB)', 'paths', 'baseline', 'baseline(KB)'))
+    for name, stats in results.items():
+        base, base_peak = '-', '-'
+        if baseline and name in baseline:
+            base = '{:.2f}'.format(baseline[name]['median_ms'])
+            base_peak = '{:.0f}'.format(baseline[name]['peak_kb'])
+        print('{:<24} {:>11.2f} {:>11.2f} {:>11.0f} {:>9} {:>11} {:>13}'.format(
+            name, stats['median_ms'], stats['p95_ms'], stats['peak_kb'], stats.get('paths', '-'), base, base_peak))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-stage benchmark of the palm reading pipeline')
+    parser.add_argument('--input', default='input/hand70.jpg', help='the path to the benchmark palm image')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint')
+    parser.add_argument('--backend', default='eager', help='UNet inference backend, see backend.py')
+    parser.add_argument('--junctions', type=int, nargs='*', default=[2, 4, 6], help='junction counts of the synthetic skeletons (the paths grow exponentially, 9 is already minutes)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown of a stage median')
+    parser.add_argument('--memory_threshold', type=float, default=0.2, help='allowed relative growth of a stage memory peak')
+    parser.add_argument('--save_baseline', default=None, help='write the results to this JSON file')
+    parser.add_argument('--detect_size', type=int, default=None, help='detect the lines at this size (e.g. 1024) with tiled inference')
+    args = parser.parse_args()
+
+    os.makedirs('results', exist_ok=True)
+    with PalmSession(args.model, backend=args.backend, detect_size=args.detect_size) as session:
+        results = run_benchmark(session, args.input, args.junctions, args.repeat, 'results/benchmark_result.jpg')
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print('peak RSS : {:.0f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.threshold, args.memory_threshold)
+        for name, metric, base, current in regressions:
+            print('REGRESSION {} {}: {:.2f} -> {:.2f} (+{:.0f}%)'.format(name, metric, base, current, (current / base - 1) * 100))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,112 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# bump when a stage changes its output, so old cache entries are not used any more
+PIPELINE_VERSION = '2'
+
+# cache key of an input image : hash of its bytes, the pipeline, the model and the centers producing the result
+def cache_key(data, session):
+    key = hashlib.sha256(data)
+    key.update('|{}|{}|{}|{}|{}|{}'.format(PIPELINE_VERSION, session.model_version, session.centers_version, session.backend, session.resize_value, session.detect_size).encode())
+    return key.hexdigest()
+
+# size of a cache entry in bytes
+def entry_size(entry):
+    size = 0
+    for value in entry.values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, list):
+            size += sum(v.nbytes for v in value if v is not None)
+    return size
+
+class ResultCache:
+    """Cache of pipeline results keyed by cache_key
+
+    an entry is a dict with
+        M, landmarks : homography and hand landmarks of rectification (None if no palm was found)
+        palmline_img : detected line mask
+        lines : classified [heart, head, life] lines (None if not found)
+    max_bytes : the in-memory tier evicts least recently used entries beyond this size
+    cache_dir : optional on-disk tier (one .npz file per entry), shared between processes
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        entry = self.load(key)
+        if entry is not None:
+            self.put_memory(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self.put_memory(key, entry)
+        self.store(key, entry)
+
+    def put_memory(self, key, entry):
+        size = entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= entry_size(self.entries.pop(key))
+            self.entries[key] = entry
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= entry_size(evicted)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def store(self, key, entry):
+        if self.cache_dir is None:
+            return
+        arrays = {}
+        if entry['M'] is not None:
+            arrays['M'] = entry['M']
+            arrays['landmarks'] = entry['landmarks']
+            arrays['palmline_img'] = entry['palmline_img']
+            for i, line in enumerate(entry['lines']):
+                if line is not None:
+                    arrays['line{}'.format(i)] = np.asarray(line)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so readers never see a partial file
+        # the temporary name is unique to the process and thread, concurrent writes of a key don't share it
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        # best effort like load : a failed write (e.g. disk full) leaves the entry in memory only
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self, key):
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return None
+        try:
+            with np.load(self.path(key)) as data:
+                if 'M' not in data:
+                    return {'M': None, 'landmarks': None, 'palmline_img': None, 'lines': [None, None, None]}
+                return {'M': data['M'], 'landmarks': data['landmarks'], 'palmline_img': data['palmline_img'],
+                        'lines': [data['line{}'.format(i)] if 'line{}'.format(i) in data else None for i in range(3)]}
+        except (OSError, ValueError):
+            return None
@@ -1,10 +1,14 @@
 import os
 import glob
+import time
 import numpy as np
 import cv2
 from PIL import Image
 from skimage.morphology import skeletonize
 import mediapipe as mp
+from skeleton_graph import SkeletonGraph
+from rectification import pts_index, pts_target_normalized
+from metrics import stage, add_count
 
 #########################################################################################
 # Sketch of idea                                                                        #
@@ -20,54 +24,49 @@ import mediapipe as mp
 
 ### 0. Load Data ###
 
+# homography rectifying a BGR PLSU palm image (not flipped), None if no hand is found
+# hands : an opened Hands context (static image mode)
+def plsu_homography(image, hands):
+    results = hands.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    if results.multi_hand_landmarks == None: return None
+    image_height, image_width, _ = image.shape
+    hand_landmarks = results.multi_hand_landmarks[0]
+    pts = np.float32([[hand_landmarks.landmark[i].x*image_width,
+                       hand_landmarks.landmark[i].y*image_height] for i in pts_index])
+    pts_target = np.float32([[x*image_width, y*image_height] for x,y in pts_target_normalized])
+    M, mask = cv2.findHomography(pts, pts_target, cv2.RANSAC,5.0)
+    return M
+
+# warp an image (or line mask) with a PLSU homography, resized to (size, size)
+def warp_plsu(image, M, size=1024):
+    image_height, image_width = image.shape[:2]
+    rectified_image = cv2.warpPerspective(image, M, (image_width, image_height))
+    pil_img = Image.fromarray(rectified_image)
+    return np.asarray(pil_img.resize((size, size), resample=Image.NEAREST))
+
+# rectify a line mask with the homography found on its BGR palm image
+# hands : an opened Hands context (static image mode)
+# returns the rectified mask resized to (size, size), or None if no hand is found
+def rectify_mask(image, image_mask, hands, size=1024):
+    M = plsu_homography(image, hands)
+    if M is None: return None
+    return warp_plsu(image_mask, M, size)
+
 # PLSU folder should exist in advance
 # rectify images in PLSU folder
 # find homography matrix using original image
 # then apply homography matrix to detected line image
 # input is the number 'idx' from image{idx}.jpg(.png)
+# (prepare_dataset.py rectifies the whole dataset in parallel)
 def rectify(idx):
     img_path = './PLSU/PLSU/'
     image = cv2.imread(img_path + 'img/image' + str(idx) +'.jpg')
     image_mask = cv2.imread(img_path + 'Mask/image' + str(idx) + '.png', cv2.IMREAD_GRAYSCALE)
     mp_hands = mp.solutions.hands
-
-    # 7 landmark points (normalized)
-    pts_index = list(range(21))
-    pts_target_normalized = np.float32([[1-0.48203104734420776, 0.9063420295715332],
-                                        [1-0.6043621301651001, 0.8119394183158875],
-                                        [1-0.6763232946395874, 0.6790258884429932],
-                                        [1-0.7340714335441589, 0.5716733932495117],
-                                        [1-0.7896472215652466, 0.5098430514335632],
-                                        [1-0.5655680298805237, 0.5117031931877136],
-                                        [1-0.5979393720626831, 0.36575648188591003],
-                                        [1-0.6135331392288208, 0.2713503837585449],
-                                        [1-0.6196483373641968, 0.19251111149787903],
-                                        [1-0.4928809702396393, 0.4982593059539795],
-                                        [1-0.4899863600730896, 0.3213786780834198],
-                                        [1-0.4894656836986542, 0.21283167600631714],
-                                        [1-0.48334982991218567, 0.12900274991989136],
-                                        [1-0.4258815348148346, 0.5180916786193848],
-                                        [1-0.4033462107181549, 0.3581996262073517],
-                                        [1-0.3938145041465759, 0.2616880536079407],
-                                        [1-0.38608720898628235, 0.1775170862674713],
-                                        [1-0.36368662118911743, 0.5642163157463074],
-                                        [1-0.33553171157836914, 0.44737303256988525],
-                                        [1-0.3209102153778076, 0.3749568462371826],
-                                        [1-0.31213682889938354, 0.3026996850967407]])
     
     with mp_hands.Hands(static_image_mode=True, max_num_hands=1, min_detection_confidence=0.5) as hands:
-        results = hands.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        
-        if results.multi_hand_landmarks == None: return np.zeros_like(image)
-        image_height, image_width, _ = image.shape
-        hand_landmarks = results.multi_hand_landmarks[0]
-        pts = np.float32([[hand_landmarks.landmark[i].x*image_width,
-                           hand_landmarks.landmark[i].y*image_height] for i in pts_index])
-        pts_target = np.float32([[x*image_width, y*image_height] for x,y in pts_target_normalized])
-        M, mask = cv2.findHomography(pts, pts_target, cv2.RANSAC,5.0)
-        rectified_image = cv2.warpPerspective(image_mask, M, (image_width, image_height))
-        pil_img = Image.fromarray(rectified_image)
-        rectified_image = np.asarray(pil_img.resize((1024, 1024), resample=Image.NEAREST))
+        rectified_image = rectify_mask(image, image_mask, hands)
+        if rectified_image is None: return np.zeros_like(image)
         return rectified_image
 
 # load rectified data from PLSU to new folder
@@ -97,56 +96,112 @@ def load_data(num_data):
 # https://stackoverflow.com/questions/63727525/how-to-connect-broken-lines-that-cannot-be-connected-by-erosion-and-dilation
 # https://stackoverflow.com/questions/43859750/how-to-connect-broken-lines-in-a-binary-image-using-python-opencv
 
-# find all possible lines by graph backtracking
-# lines_node : list of lines represented by nodes // ex. [[node0, ..., node3], ..., [node2, ..., node4]]
-# temp : list of nodes up to now
-# graph : node -> {adj. node -> line between two node} (dictionary type)
-# visited_node : visited nodes up to now
-# finished_node : visited nodes at least once
-# node : current node
-def backtrack(lines_node, temp, graph, visited_node, finished_node, node):
-    end_pt = True
-    for next_node in graph[node].keys():
-        if not visited_node[next_node]:
-            end_pt = False
-            temp.append(next_node)
-            visited_node[next_node] = True
-            finished_node[next_node] = True
-            backtrack(lines_node, temp, graph, visited_node, finished_node, next_node)
-            del temp[-1]
-            visited_node[next_node] = False
-    # if there is no way to preceed, current node is the end node
-    # add current line to the list
-    if end_pt:
-        line_node = []
-        line_node.extend(temp)
-        lines_node.append(line_node)
+# caps on the line enumeration of one image (None = no cap)
+# MAX_PATHS : the number of paths walked to an end
+# PATH_TIME_LIMIT : seconds spent enumerating, checked on every step of the walk
+MAX_PATHS = 20000
+PATH_TIME_LIMIT = 1.0
+
+# find all possible lines by walking the graph iteratively (depth-first, no recursion)
+# a line is a simple path of nodes which stops where no unvisited adjacent node is left
+# paths start from the first node of each connected component, in node order
+# graph : SkeletonGraph (see skeleton_graph.py)
+# paths turning back (inner product of consecutive segment vectors <0) are cut while walking,
+# paths shorter than min_length pixels are dropped when they end
+# returns the list of lines, each a (L,4) int16 array of [y, x, dy, dx]
+def find_lines(graph, min_length=10, max_paths=MAX_PATHS, time_limit=PATH_TIME_LIMIT):
+    nodes = graph.nodes.tolist()
+    indptr = graph.indptr.tolist()
+    adj_node = graph.adj_node.tolist()
+    adj_edge = graph.adj_edge.tolist()
+    # adjacency of each node as (adj. node, edge) pairs
+    adj = [list(zip(adj_node[indptr[i]:indptr[i+1]], adj_edge[indptr[i]:indptr[i+1]])) for i in range(len(nodes))]
+    edge_length = np.diff(graph.edge_ptr).tolist()
+
+    lines = []
+    num_paths = 0
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    finished_node = [False] * len(nodes)
+    for start in range(len(nodes)):
+        if finished_node[start]: continue
+
+        # every node connected to 'start' is reached by some path from it
+        component = [start]
+        finished_node[start] = True
+        for node in component:
+            for next_node, _ in adj[node]:
+                if not finished_node[next_node]:
+                    finished_node[next_node] = True
+                    component.append(next_node)
+        if not adj[start]: continue  # isolated node
+
+        path = [start]
+        edges = []  # edges[i] : edge from path[i] to path[i+1]
+        length = [0]  # length[i] : number of pixels of the line along path[:i+1]
+        visited_node = [False] * len(nodes)
+        visited_node[start] = True
+        stack = [iter(adj[start])]
+        while stack:
+            if deadline is not None and time.perf_counter() > deadline:
+                add_count('paths_explored', num_paths)
+                add_count('path_enumeration_capped')
+                return lines
+            cur = nodes[path[-1]]
+            for next_node, edge in stack[-1]:
+                if visited_node[next_node]: continue
+                nxt = nodes[next_node]
+                if len(path) > 1:
+                    prev = nodes[path[-2]]
+                    if (cur[0]-prev[0])*(nxt[0]-cur[0])+(cur[1]-prev[1])*(nxt[1]-cur[1]) < 0: continue
+                if all(visited_node[adj_node] or adj_node == next_node for adj_node, _ in adj[next_node]):
+                    # end of a path
+                    num_paths += 1
+                    if length[-1] + edge_length[edge if edge >= 0 else ~edge] >= min_length:
+                        lines.append(graph.line_pixels(edges + [edge]))
+                    if max_paths is not None and num_paths >= max_paths:
+                        add_count('paths_explored', num_paths)
+                        add_count('path_enumeration_capped')
+                        return lines
+                    continue
+                path.append(next_node)
+                edges.append(edge)
+                length.append(length[-1] + edge_length[edge if edge >= 0 else ~edge])
+                visited_node[next_node] = True
+                stack.append(iter(adj[next_node]))
+                break
+            else:
+                # all adjacent nodes are explored
+                del stack[-1]
+                visited_node[path[-1]] = False
+                del path[-1], length[-1]
+                if edges: del edges[-1]
+    add_count('paths_explored', num_paths)
+    return lines
 
 # find possible lines
 # (1) build a graph
-# (2) find all possible lines by graph backtracking
-# (3) filter lines with length, direction criteria
-def group(img):
+# (2) find all possible lines by walking the graph
+# (3) filter lines with length, direction criteria (while walking)
+# max_paths / time_limit : caps on the enumeration, see find_lines
+def group(img, max_paths=MAX_PATHS, time_limit=PATH_TIME_LIMIT):
     # (1) build a graph
     
     # (1)-1 find all nodes
-    count = np.zeros(img.shape)
-    nodes = []
-
-    for j in range(1, img.shape[0] - 1):
-        for i in range(1, img.shape[1] - 1):
-            if img[j, i] == 0: continue
-            count[j, i] = np.count_nonzero(img[j-1:j+2, i-1:i+2]) - 1
-            if count[j, i] == 1 or count[j, i] >= 3:
-                nodes.append((j, i))
+    # count : the number of nonzero neighbors of each line pixel (0 for background and image border)
+    line_pixel = (img > 0).astype(np.float32)
+    count = cv2.filter2D(line_pixel, -1, np.ones((3, 3), np.float32), borderType=cv2.BORDER_CONSTANT) - 1
+    count[line_pixel == 0] = 0
+    count[[0, -1], :] = 0
+    count[:, [0, -1]] = 0
+    # nodes = end points (count 1) and intersections (count >= 3), in row-major order
+    node_y, node_x = np.nonzero((count == 1) | (count >= 3))
 
     # sort nodes to traverse from upper-left to lower-right
-    nodes.sort(key = lambda x : x[0]+x[1])
+    order = np.argsort(node_y + node_x, kind='stable')
+    nodes = list(zip(node_y[order].tolist(), node_x[order].tolist()))
      
     # (1)-2 save all connections
-    graph = dict()
-    for node in nodes:
-        graph[node] = dict()
+    graph = SkeletonGraph(nodes)
 
     not_visited = np.ones(img.shape)
     for node in nodes:
@@ -164,9 +219,7 @@ def group(img):
             temp_line = [[y,x,0,0], [next_y,next_x,dy-1,dx-1]]
             if count[next_y, next_x] == 1 or count[next_y, next_x] >= 3:
                 not_visited[next_y, next_x] = 1
-                graph[tuple(temp_line[0][:2])][tuple(temp_line[-1][:2])] = temp_line
-                temp_line_rev = list(reversed(temp_line))
-                graph[tuple(temp_line[-1][:2])][tuple(temp_line[0][:2])] = temp_line_rev
+                graph.add_edge(temp_line)
                 continue
         
             while(True):
@@ -188,48 +241,20 @@ def group(img):
                 # check end condition
                 if count[next_y, next_x] == 1 or count[next_y, next_x] >= 3:
                     #if len(temp_line) > 10:
-                    graph[tuple(temp_line[0][:2])][tuple(temp_line[-1][:2])] = temp_line
-                    temp_line_rev = list(reversed(temp_line))
-                    graph[tuple(temp_line[-1][:2])][tuple(temp_line[0][:2])] = temp_line_rev
+                    graph.add_edge(temp_line)
                     not_visited[next_y, next_x] = 1
                     break
         not_visited[node[0], node[1]] = 1
+    graph.freeze()
+    add_count('skeleton_nodes', graph.num_nodes)
+    add_count('graph_edges', graph.num_edges)
 
 
-    # (2) find all possible lines by graph backtracking
-    lines_node = []
-    visited_node = dict()
-    finished_node = dict()
-    for node in nodes:
-        visited_node[node] = False
-        finished_node[node] = False
-    
-    for node in nodes:
-        if not finished_node[node]:
-            temp = [node]
-            visited_node[node] = True
-            finished_node[node] = True
-            backtrack(lines_node, temp, graph, visited_node, finished_node, node)
-    
+    # (2) find all possible lines by walking the graph
     # (3) filter lines with length, direction criteria
-    lines = []
-    for line_node in lines_node:
-        num_node = len(line_node)
-        if num_node == 1 : continue
-        wrong = False
-        line = []
-        prev,cur = None,line_node[0]
-        for i in range(1,num_node):
-            nxt = line_node[i]
-            # if the inner product of two connected line segments vectors is <0, discard it
-            if i>1 and (cur[0]-prev[0])*(nxt[0]-cur[0])+(cur[1]-prev[1])*(nxt[1]-cur[1])<0:
-                wrong = True
-                break
-            line.extend(graph[cur][nxt])
-            prev,cur = cur,nxt
-        # if the length is <10, discard it
-        if wrong or len(line) < 10: continue
-        lines.append(line)
+    with stage('find_lines'):
+        lines = find_lines(graph, 10, max_paths, time_limit)
+    add_count('candidate_lines', len(lines))
     
     return lines
 
@@ -240,32 +265,39 @@ def group(img):
 def classify_lines(centers, lines, image_height, image_width):
     classified_lines = [None, None, None]
     line_idx = [None, None, None]
-    nearest = [1e9, 1e9, 1e9]
+    if len(lines) == 0:
+        return classified_lines
     
-    feature_list = np.empty((0,24))
-    for line in lines:
-        feature = extract_feature(line, image_height, image_width)
-        feature_list = np.vstack((feature_list,feature))
+    # distances[j, i] : l2 distance between line j and center i in feature space
+    features = extract_features(lines, image_height, image_width)
+    distances = np.linalg.norm(features[:, None, :] - np.asarray(centers)[None, :, :], axis=2)
+    distances[np.isnan(distances)] = np.inf
     
-    num_lines = len(lines)
     for i in range(3):
-        center = centers[i]
-        for j in range(num_lines):
-            chosen = False
-            for k in range(i-1):
-                if line_idx[k]==j:
-                    chosen = True
-                    break
-            if chosen: continue
-            feature = feature_list[j]
-            dist = np.linalg.norm(feature-center)
-            if dist < nearest[i]:
-                nearest[i] = dist
-                classified_lines[i] = lines[j]
-                line_idx[i] = j
+        dist = distances[:, i].copy()
+        # skip lines already chosen by the centers before the previous one
+        for k in range(i-1):
+            if line_idx[k] is not None:
+                dist[line_idx[k]] = np.inf
+        j = int(np.argmin(dist))
+        if dist[j] < 1e9:
+            classified_lines[i] = lines[j]
+            line_idx[i] = j
     
     return classified_lines
 
+# scale the [y, x] pixels of lines found on a from_size mask to a to_size image
+def scale_lines(lines, from_size, to_size):
+    if from_size == to_size:
+        return lines
+    scaled = []
+    for line in lines:
+        if line is not None:
+            line = line.copy()
+            line[:, :2] = np.minimum(line[:, :2].astype(np.int64) * to_size // from_size, to_size - 1)
+        scaled.append(line)
+    return scaled
+
 ### 3. Color each line ###
 
 # color lines with BGR
@@ -284,23 +316,56 @@ def color(skel_img, lines):
 
 ### Others ###
 
-# extract feature from a line
-def extract_feature(line, image_height, image_width):
+# extract features from all lines at once, returns a (num_lines, 2N+4) array
+def extract_features(lines, image_height, image_width):
     # feature = [min_y, min_x, max_y, max_x] + mean of direction info(dy,dx) * N intervals
     # => (2N+4)-dim
-    image_size = np.array([image_height, image_width], dtype=np.float32)
-    feature = np.append(np.min(line, axis=0)[:2]/image_size, np.max(line, axis=0)[:2]/image_size)
-    feature *= 10
     N = 10
-    step = len(line)//N
-    for i in range(N):
-        l = line[i*step:(i+1)*step]
-        feature = np.append(feature, np.mean(l, axis=0)[2:])
-    return feature
+    if len(lines) == 0:
+        return np.empty((0, 2*N+4))
+    lengths = np.array([len(line) for line in lines])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pixels = np.concatenate(lines).astype(np.int64)
+    image_size = np.array([image_height, image_width], dtype=np.float32)
+
+    features = np.empty((len(lines), 2*N+4))
+    features[:, :2] = np.minimum.reduceat(pixels[:, :2], starts, axis=0) / image_size
+    features[:, 2:4] = np.maximum.reduceat(pixels[:, :2], starts, axis=0) / image_size
+    features[:, :4] *= 10
+
+    # interval i of a line covers line[i*step:(i+1)*step], summed with a cumulative sum over all pixels
+    step = lengths // N
+    cumsum = np.concatenate((np.zeros((1, 2), dtype=np.int64), np.cumsum(pixels[:, 2:], axis=0)))
+    interval_start = starts[:, None] + np.arange(N)[None, :] * step[:, None]
+    interval_sum = cumsum[interval_start + step[:, None]] - cumsum[interval_start]
+    with np.errstate(invalid='ignore'):
+        features[:, 4:] = (interval_sum / step[:, None, None]).reshape(len(lines), 2*N)
+    return features
+
+# extract feature from a line
+def extract_feature(line, image_height, image_width):
+    return extract_features([line], image_height, image_width)[0]
       
 
+# centers trained by train_centers.py, used instead of the pre-trained literals when the file exists
+CENTERS_PATH = os.environ.get('PALM_CENTERS', 'checkpoint/centers.npz')
+# (version, centers) loaded by load_centers, once per process
+loaded_centers = None
+
+# load the trained centers, returns (version, list of centers) or ('builtin', None) without a centers file
+def load_centers(path=None):
+    global loaded_centers
+    if loaded_centers is None or path is not None:
+        path = path or CENTERS_PATH
+        if os.path.exists(path):
+            with np.load(path) as data:
+                loaded_centers = (str(data['version']), list(data['centers'].astype(np.float32)))
+        else:
+            loaded_centers = ('builtin', None)
+    return loaded_centers
+
 # find 3 cluster centers in feature space
-# we can use pre-trained centers for testing
+# we can use pre-trained centers for testing (trained ones from CENTERS_PATH if any, see load_centers)
 def get_cluster_centers(new_centers=False):
     if new_centers:
         # prepare good samples
@@ -310,14 +375,13 @@ def get_cluster_centers(new_centers=False):
             cv2.imwrite("good_sample/image"+str(idx)+".png",rectified)
         
         # put all data in feature space
-        data = np.empty((0,24))
+        data = []
         for img_path in glob.glob("good_sample/*.png"):
             img = cv2.imread(img_path)
             skel_img = cv2.cvtColor(skeletonize(img), cv2.COLOR_BGR2GRAY)
             lines = group(skel_img)
-            for line in lines:
-                feature = extract_feature(line, 1024, 1024)
-                data = np.vstack((data,feature))
+            data.append(extract_features(lines, 1024, 1024))
+        data = np.concatenate(data)
         
         # k-means clustering (k=3)
         criteria = (cv2.TERM_CRITERIA_EPS|cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
@@ -327,6 +391,8 @@ def get_cluster_centers(new_centers=False):
         centers = list(centers)
         centers.sort(key = lambda x : x[2])
     else:
+        centers = load_centers()[1]
+    if centers is None:
         centers = [np.array([5.232849  , 4.881592  , 6.3223267 , 6.64093   , 0.8113839 ,
                             0.655735  , 0.82874316, 0.74796075, 0.7993417 , 0.8345605 ,
                             0.68143266, 0.90320605, 0.5769709 , 0.9721149 , 0.53258324,
@@ -344,7 +410,9 @@ def get_cluster_centers(new_centers=False):
                             0.8069528 , 0.25324377, 0.59989274, 0.32016128], dtype=np.float32)]
     return centers
 
-def classify(path_to_palmline_image):
+# classify lines of a detected line mask (H,W), nonzero pixels are lines
+# max_paths / time_limit : caps on the line enumeration, see find_lines
+def classify_image(palmline_img, max_paths=MAX_PATHS, time_limit=PATH_TIME_LIMIT):
     # load (rectified) test data
     # num_data = 10
     # load_data(num_data)
@@ -352,18 +420,22 @@ def classify(path_to_palmline_image):
     # get cluster centers
     centers = get_cluster_centers()
 
-    palmline_img = cv2.imread(path_to_palmline_image)
     kernel = np.ones((3, 3), np.uint8)
     # dilated = cv2.dilate(palmline_img, kernel, iterations=3)
     # eroded = cv2.erode(dilated, kernel, iterations=3)
-    gray = cv2.cvtColor(palmline_img, cv2.COLOR_BGR2GRAY)
-    skel = skeletonize(gray > 0)
-    skel_img = (skel * 255).astype(np.uint8)
+    with stage('skeletonize'):
+        skel = skeletonize(palmline_img > 0)
+        skel_img = (skel * 255).astype(np.uint8)
     
     #cv2.imwrite('results/skel.jpg',skel_img)
     
-    lines = group(skel_img)  # get candidate lines
-    lines = classify_lines(centers, lines, palmline_img.shape[0], palmline_img.shape[1])  # choose 3 lines from candidates
+    with stage('group'):
+        lines = group(skel_img, max_paths, time_limit)  # get candidate lines
+    with stage('classify_lines'):
+        lines = classify_lines(centers, lines, palmline_img.shape[0], palmline_img.shape[1])  # choose 3 lines from candidates
     # colored_img = color(skel_img, classified_lines) # color 3 lines (RGB)
 
-    return lines
\ No newline at end of file
+    return lines
+
+def classify(path_to_palmline_image):
+    return classify_image(cv2.imread(path_to_palmline_image, cv2.IMREAD_GRAYSCALE))
@@ -1,11 +1,101 @@
 import numpy as np
 from PIL import Image
-import torch
+from onnx_net import OnnxNet
 
-def detect(net, jpeg_dir, output_dir, resize_value, device=torch.device('cpu')):
+# logits above this value are line pixels
+LINE_THRESHOLD = 0.03
+
+# tiled detection (detect_tiled) : tile side and overlap in pixels (multiples of 16, the UNet pools 4 times)
+TILE_SIZE = 256
+TILE_OVERLAP = 32
+# UNet activation memory per input pixel during a forward pass (measured, ~2.2 KB on CPU float32)
+# and default cap of the memory used by one batch of tiles
+ACTIVATION_BYTES_PER_PIXEL = 2400
+TILE_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# resize an RGB palm image and convert it to the float32 CHW array the net expects
+def preprocess(rgb_img, resize_value):
+    img = np.asarray(Image.fromarray(rgb_img).resize((resize_value, resize_value), resample=Image.NEAREST), dtype=np.float32) / 255
+    return img.transpose(2,0,1)
+
+# logits (N,H,W) float32 of a (N,3,H,W) float32 batch
+# net : the torch UNet (any backend.py backend) or an onnx_net.OnnxNet, torch is only imported for the former
+def forward(net, batch, device=None, channels_last=False):
+    if isinstance(net, OnnxNet):
+        return net(batch)[:, 0]
+    import torch
+    with torch.inference_mode():
+        batch = torch.from_numpy(batch).to(device or torch.device('cpu'))
+        if channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return net(batch)[:, 0].float().cpu().numpy()
+
+# detect principal lines of N preprocessed palms with a single forward pass
+# imgs : list of (3,H,W) float32 arrays from preprocess, all the same size
+# returns the list of line masks (H,W) as uint8 (0 or 255),
+# and with return_probs also the list of line probability maps (H,W) as float16
+def detect_batch(net, imgs, device=None, channels_last=False, threshold=LINE_THRESHOLD, return_probs=False):
+    preds = forward(net, np.stack(imgs), device, channels_last)
+    masks = list((preds > threshold).astype(np.uint8) * 255)
+    if return_probs:
+        return masks, list((1 / (1 + np.exp(-preds))).astype(np.float16))
+    return masks
+
+# top-left offsets of the tiles covering [0, size), the last tile is aligned to the end
+def tile_offsets(size, tile_size, overlap):
+    if size <= tile_size:
+        return [0]
+    offsets = list(range(0, size - tile_size, tile_size - overlap))
+    return offsets + [size - tile_size]
+
+# blending weight of a (height,width) tile : ramps up over the overlap from each border, so tile borders
+# (where the convolutions see zero padding instead of the neighbouring pixels) count less
+def tile_weight(height, width, overlap):
+    ramps = []
+    for size in [height, width]:
+        ramp = np.minimum(np.arange(size), np.arange(size)[::-1]) + 1
+        ramps.append(np.minimum(ramp, overlap + 1).astype(np.float32) / (overlap + 1))
+    return np.outer(*ramps)
+
+# detect principal lines of N preprocessed palms of any size (e.g. 1024x1024) tile by tile
+# the tiles of all images overlap by overlap pixels, go through the net in batches that fit in memory_limit
+# bytes of activations, and their logits are blended back with tile_weight before thresholding
+# images smaller than a tile are run whole
+# same arguments and returns as detect_batch
+def detect_tiled(net, imgs, device=None, channels_last=False, threshold=LINE_THRESHOLD, return_probs=False,
+                 tile_size=TILE_SIZE, overlap=TILE_OVERLAP, memory_limit=TILE_MEMORY_LIMIT):
+    # tiles grouped by shape, only tiles of the same shape can be batched
+    tiles = {}
+    for i, img in enumerate(imgs):
+        height, width = img.shape[1:]
+        for y in tile_offsets(height, tile_size, overlap):
+            for x in tile_offsets(width, tile_size, overlap):
+                shape = (min(tile_size, height), min(tile_size, width))
+                tiles.setdefault(shape, []).append((i, y, x))
+
+    logits = [np.zeros(img.shape[1:], dtype=np.float32) for img in imgs]
+    weights = [np.zeros(img.shape[1:], dtype=np.float32) for img in imgs]
+    for (height, width), shape_tiles in tiles.items():
+        weight = tile_weight(height, width, overlap)
+        batch_size = max(1, memory_limit // (ACTIVATION_BYTES_PER_PIXEL * height * width))
+        for start in range(0, len(shape_tiles), batch_size):
+            batch = shape_tiles[start:start+batch_size]
+            preds = forward(net, np.stack([imgs[i][:, y:y+height, x:x+width] for i, y, x in batch]), device, channels_last)
+            for (i, y, x), pred in zip(batch, preds):
+                logits[i][y:y+height, x:x+width] += pred * weight
+                weights[i][y:y+height, x:x+width] += weight
+
+    preds = [logit / weight for logit, weight in zip(logits, weights)]
+    masks = [(pred > threshold).astype(np.uint8) * 255 for pred in preds]
+    if return_probs:
+        return masks, [(1 / (1 + np.exp(-pred))).astype(np.float16) for pred in preds]
+    return masks
+
+# detect principal lines from an RGB palm image, returns the line mask (H,W)
+def detect_lines(net, rgb_img, resize_value, device=None, channels_last=False):
+    return detect_batch(net, [preprocess(rgb_img, resize_value)], device, channels_last)[0]
+
+def detect(net, jpeg_dir, output_dir, resize_value, device=None):
     pil_img = Image.open(jpeg_dir)
-    img = np.asarray(pil_img.resize((resize_value, resize_value), resample=Image.NEAREST)) / 255
-    img = torch.tensor(img, dtype=torch.float32).unsqueeze(0).permute(0,3,1,2).to(device)
-    pred = net(img).squeeze(0)
-    pred = torch.Tensor(np.apply_along_axis(lambda x: [1,1,1] if x > 0.03 else [0,0,0], 0, pred.cpu().detach()))
-    Image.fromarray((pred.permute((1,2,0)).numpy() * 255).astype(np.uint8)).save(output_dir)
\ No newline at end of file
+    palmline_img = detect_lines(net, np.asarray(pil_img), resize_value, device)
+    Image.fromarray(palmline_img).save(output_dir)
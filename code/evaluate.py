@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import itertools
+import multiprocessing
+import numpy as np
+import cv2
+from tools import clean_background
+from rectification import create_hands
+from detection import preprocess, detect_batch, LINE_THRESHOLD
+from classification import plsu_homography, warp_plsu, classify_image, MAX_PATHS, PATH_TIME_LIMIT
+from session import PalmSession
+from backend import mask_iou
+from prepare_dataset import list_plsu
+
+#########################################################################################
+# Accuracy vs. throughput evaluation over PLSU                                          #
+# (1) every PLSU image and its ground-truth line mask are rectified once with the      #
+#     rectify logic of classification.py and kept in eval_dir (in parallel, resumable) #
+# (2) for each configuration (resize_value, threshold, backend, path caps), the        #
+#     detection and classification run on a process pool over the rectified images    #
+# (3) line-mask IoU against the ground truth, agreement of the three classified lines  #
+#     with the ones classified on the ground truth, images/sec and peak RSS per config #
+#########################################################################################
+
+# Hands context (rectification) or session and config (evaluation) of the current worker process
+hands = None
+session = None
+config = None
+
+def init_rectify_worker():
+    global hands
+    cv2.setNumThreads(1)
+    hands = create_hands()
+
+# worker : rectify one PLSU image and its mask into eval_dir, returns (idx, ok)
+def rectify_pair(task):
+    idx, path_to_image, path_to_mask, eval_dir, size = task
+    image = cv2.imread(path_to_image)
+    image_mask = cv2.imread(path_to_mask, cv2.IMREAD_GRAYSCALE)
+    if image is None or image_mask is None:
+        return idx, False
+    M = plsu_homography(image, hands)
+    if M is None:
+        return idx, False
+    cv2.imwrite(os.path.join(eval_dir, 'image{}.jpg'.format(idx)), warp_plsu(image, M, size), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    cv2.imwrite(os.path.join(eval_dir, 'mask{}.png'.format(idx)), warp_plsu(image_mask, M, size))
+    return idx, True
+
+# rectify the PLSU pairs missing from eval_dir, returns the idx of the rectified pairs
+def prepare_pairs(plsu_dir, eval_dir, workers=None, limit=None, size=1024):
+    os.makedirs(eval_dir, exist_ok=True)
+    samples = list_plsu(plsu_dir)[:limit]
+    done = lambda idx: os.path.exists(os.path.join(eval_dir, 'mask{}.png'.format(idx)))
+    tasks = [(idx, path_to_image, path_to_mask, eval_dir, size) for idx, path_to_image, path_to_mask in samples if not done(idx)]
+    if tasks:
+        with multiprocessing.get_context('spawn').Pool(workers or os.cpu_count(), init_rectify_worker) as pool:
+            for num_done, _ in enumerate(pool.imap_unordered(rectify_pair, tasks), 1):
+                print('[{}/{}] rectified'.format(num_done, len(tasks)), file=sys.stderr)
+    return [idx for idx, _, _ in samples if done(idx)]
+
+# fraction of the three lines on which two classifications agree : both missing, or
+# at least half of the pixels of each line within tolerance pixels of the other line
+def line_agreement(lines, target_lines, shape, tolerance=3):
+    agree = 0
+    for line, target in zip(lines, target_lines):
+        if line is None or target is None:
+            agree += line is None and target is None
+            continue
+        close = []
+        for a, b in [(line, target), (target, line)]:
+            canvas = np.full(shape, 255, dtype=np.uint8)
+            canvas[b[:, 0], b[:, 1]] = 0
+            distance = cv2.distanceTransform(canvas, cv2.DIST_L2, 3)
+            close.append((distance[a[:, 0], a[:, 1]] <= tolerance).mean())
+        agree += min(close) >= 0.5
+    return agree / 3
+
+# ready : barrier of the workers and the parent, the wall clock starts once every worker is loaded and warmed up
+def init_eval_worker(path_to_model, eval_config, num_threads, ready):
+    global session, config
+    config = eval_config
+    session = PalmSession(path_to_model, config['resize_value'], backend=config['backend'], num_threads=num_threads)
+    ready.wait()
+
+# shrink a line mask to size x size without breaking thin lines : a pixel is a line pixel when any
+# part of its area was one (INTER_AREA then threshold), where NEAREST drops most pixels of 1-2 px lines
+def shrink_mask(mask, size):
+    area = cv2.resize(mask, (size, size), interpolation=cv2.INTER_AREA)
+    return (area > 0).astype(np.uint8) * 255
+
+# worker : ground truth of a chunk of rectified pairs, returns [(mask, lines)...] at the resize_value of the config
+def ground_truth_chunk(task):
+    eval_dir, chunk = task
+    targets = [shrink_mask(cv2.imread(os.path.join(eval_dir, 'mask{}.png'.format(idx)), cv2.IMREAD_GRAYSCALE), config['resize_value']) for idx in chunk]
+    return [(target, classify_image(target)) for target in targets]
+
+# worker : detect and classify a chunk of rectified images, returns ([(mask, lines)...], seconds, peak RSS in bytes)
+def evaluate_chunk(task):
+    eval_dir, chunk = task
+    images = [cv2.imread(os.path.join(eval_dir, 'image{}.jpg'.format(idx))) for idx in chunk]
+    resize_value = config['resize_value']
+
+    start = time.perf_counter()
+    imgs = [preprocess(cv2.cvtColor(clean_background(image), cv2.COLOR_BGR2RGB), resize_value) for image in images]
+    masks = detect_batch(session.net, imgs, session.device, threshold=config['threshold'])
+    lines = [classify_image(mask, config['max_paths'], config['time_limit']) for mask in masks]
+    seconds = time.perf_counter() - start
+    return list(zip(masks, lines)), seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# evaluate one configuration on a fresh pool, returns a row of the result table
+# images_per_sec times the pipeline only (image reading, detection, classification) : the pool start-up, the model
+# loading and warm-up, the ground-truth classification and the scoring are all outside the wall clock
+def evaluate_config(eval_dir, indices, eval_config, path_to_model, workers, chunk_size=8):
+    workers = workers or os.cpu_count()
+    num_threads = max(1, os.cpu_count() // workers)
+    tasks = [(eval_dir, indices[i:i+chunk_size]) for i in range(0, len(indices), chunk_size)]
+    context = multiprocessing.get_context('spawn')
+    ready = context.Barrier(workers + 1)
+    outputs, peak_rss, busy = [], 0, 0.0
+    with context.Pool(workers, init_eval_worker, (path_to_model, eval_config, num_threads, ready)) as pool:
+        ready.wait()
+        targets = pool.map(ground_truth_chunk, tasks)
+        start = time.perf_counter()
+        for chunk_outputs, seconds, rss in pool.imap(evaluate_chunk, tasks):
+            outputs.append(chunk_outputs)
+            busy += seconds
+            peak_rss = max(peak_rss, rss)
+        wall = time.perf_counter() - start
+
+    scores = []
+    for chunk_outputs, chunk_targets in zip(outputs, targets):
+        for (mask, lines), (target, target_lines) in zip(chunk_outputs, chunk_targets):
+            scores.append((mask_iou(mask, target), line_agreement(lines, target_lines, target.shape)))
+    scores = np.array(scores).reshape(-1, 2)
+    return dict(eval_config,
+                iou=float(scores[:, 0].mean()) if len(scores) else None,
+                line_agreement=float(scores[:, 1].mean()) if len(scores) else None,
+                images_per_sec=len(scores) / wall if wall else None,
+                images_per_sec_per_worker=len(scores) / busy if busy else None,
+                peak_rss_mb=peak_rss / 1024 / 1024)
+
+def print_table(rows):
+    print('{:>6} {:>9} {:>8} {:>9} {:>6} {:>7} {:>9} {:>10} {:>9}'.format(
+        'size', 'threshold', 'backend', 'max_paths', 'limit', 'IoU', 'agreement', 'images/s', 'peak(MB)'))
+    for row in rows:
+        print('{:>6} {:>9} {:>8} {:>9} {:>6} {:>7.4f} {:>9.3f} {:>10.2f} {:>9.0f}'.format(
+            row['resize_value'], row['threshold'], row['backend'], str(row['max_paths']), str(row['time_limit']),
+            row['iou'], row['line_agreement'], row['images_per_sec'], row['peak_rss_mb']))
+
+# 'none' on the command line disables a cap
+def cap(value, type):
+    return None if value.lower() == 'none' else type(value)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='evaluate accuracy and throughput of pipeline configurations over PLSU')
+    parser.add_argument('--plsu_dir', default='./PLSU/PLSU', help='directory with the img/ (or Img/) and Mask/ folders')
+    parser.add_argument('--eval_dir', default='./eval_data', help='rectified images and masks, reused between runs')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint')
+    parser.add_argument('--limit', type=int, default=None, help='evaluate on the first images only')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--resize_values', type=int, nargs='+', default=[256])
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[LINE_THRESHOLD])
+    parser.add_argument('--backends', nargs='+', default=['eager'], help='see backend.py')
+    parser.add_argument('--max_paths', type=lambda value: cap(value, int), nargs='+', default=[MAX_PATHS], help="'none' = no cap")
+    parser.add_argument('--time_limits', type=lambda value: cap(value, float), nargs='+', default=[PATH_TIME_LIMIT], help="'none' = no cap")
+    parser.add_argument('--json', default=None, help='also write the table to this JSON file')
+    args = parser.parse_args()
+
+    indices = prepare_pairs(args.plsu_dir, args.eval_dir, args.workers, args.limit)
+    if not indices:
+        sys.exit('no rectified PLSU image to evaluate')
+    print('{} rectified images'.format(len(indices)))
+
+    rows = []
+    for resize_value, threshold, backend, max_paths, time_limit in itertools.product(
+            args.resize_values, args.thresholds, args.backends, args.max_paths, args.time_limits):
+        eval_config = {'resize_value': resize_value, 'threshold': threshold, 'backend': backend, 'max_paths': max_paths, 'time_limit': time_limit}
+        rows.append(evaluate_config(args.eval_dir, indices, eval_config, args.model, args.workers))
+        print_table(rows[-1:])
+    print()
+    print_table(rows)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -1,6 +1,9 @@
 from PIL import Image, ImageDraw
 import cv2
 import mediapipe as mp
+from contextlib import nullcontext
+import numpy as np
+from rectification import hands_context
 
 def classify_line_length(tip_position, thresholds):
     """Phân loại độ dài đường chỉ tay thành 10 mức"""
@@ -9,21 +12,28 @@ def classify_line_length(tip_position, thresholds):
             return i
     return len(thresholds)  # Mức cao nhất
 
-def measure(path_to_warped_image_mini, lines):
+# measure line lengths on a BGR warped palm image, returns the annotated image and contents
+# hands : an opened Hands context to reuse
+# landmarks : (21,2) normalized landmarks of the flipped warped image (see rectification.warped_landmarks),
+#             detected again on warped_image_mini if None
+def measure_image(warped_image_mini, lines, hands=None, landmarks=None):
     heart_thres_x = [0] * 9  # 9 ngưỡng cho 10 mức
     head_thres_x = [0] * 9
     life_thres_y = [0] * 9
 
     mp_hands = mp.solutions.hands
-    with mp_hands.Hands(static_image_mode=True, max_num_hands=1, min_detection_confidence=0.5) as hands:
-        image = cv2.flip(cv2.imread(path_to_warped_image_mini), 1)
+    with hands_context(hands) if landmarks is None else nullcontext() as hands:
+        image = cv2.flip(warped_image_mini, 1)
         image_height, image_width, _ = image.shape
 
-        results = hands.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        if landmarks is None:
+            results = hands.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            if results.multi_hand_landmarks:
+                landmarks = np.float32([[landmark.x, landmark.y] for landmark in results.multi_hand_landmarks[0].landmark])
         
         # Kiểm tra nếu không phát hiện được tay
-        if not results.multi_hand_landmarks:
-            im = Image.open(path_to_warped_image_mini)
+        if landmarks is None:
+            im = Image.fromarray(cv2.cvtColor(warped_image_mini, cv2.COLOR_BGR2RGB))
             draw = ImageDraw.Draw(im)
             
             # Kiểm tra nếu lines là None hoặc rỗng
@@ -61,13 +71,11 @@ def measure(path_to_warped_image_mini, lines):
             
             return im, contents
         
-        hand_landmarks = results.multi_hand_landmarks[0]
-
-        zero = hand_landmarks.landmark[mp_hands.HandLandmark(0).value].y
-        one = hand_landmarks.landmark[mp_hands.HandLandmark(1).value].y
-        five = hand_landmarks.landmark[mp_hands.HandLandmark(5).value].x
-        nine = hand_landmarks.landmark[mp_hands.HandLandmark(9).value].x
-        thirteen = hand_landmarks.landmark[mp_hands.HandLandmark(13).value].x
+        zero = landmarks[mp_hands.HandLandmark(0).value][1]
+        one = landmarks[mp_hands.HandLandmark(1).value][1]
+        five = landmarks[mp_hands.HandLandmark(5).value][0]
+        nine = landmarks[mp_hands.HandLandmark(9).value][0]
+        thirteen = landmarks[mp_hands.HandLandmark(13).value][0]
 
         # Điều chỉnh các ngưỡng cho tay người Việt Nam với 10 mức phân loại
         base_heart_x = image_width * (1 - (nine + (five - nine) * 0.35))  
@@ -85,7 +93,7 @@ def measure(path_to_warped_image_mini, lines):
             head_thres_x[i] = base_head_x + (i - 4) * head_offset
             life_thres_y[i] = base_life_y + (i - 4) * life_offset
 
-    im = Image.open(path_to_warped_image_mini)
+    im = Image.fromarray(cv2.cvtColor(warped_image_mini, cv2.COLOR_BGR2RGB))
     width = 3
     draw = ImageDraw.Draw(im)
     
@@ -179,4 +187,7 @@ def measure(path_to_warped_image_mini, lines):
     else:
         contents.extend(['Đường sinh mệnh:', 'Không tìm thấy đường sinh mệnh trên lòng bàn tay của bạn. Đường này thường rõ nhất, hãy kiểm tra lại ảnh chụp.'])
 
-    return im, contents
\ No newline at end of file
+    return im, contents
+
+def measure(path_to_warped_image_mini, lines):
+    return measure_image(cv2.imread(path_to_warped_image_mini), lines)
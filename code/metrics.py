@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+#########################################################################################
+# Instrumentation of the pipeline                                                      #
+# - stage(name) : times a block (wall time, CPU time, RSS and allocation deltas)        #
+# - add_count(name, n) : adds to a counter (skeleton nodes, graph edges, lines, ...)    #
+# both record into the trace of the current request, set by tracing()                  #
+# without an active trace they do nothing (one context variable lookup)                #
+# MetricsRegistry aggregates traces and exports them in Prometheus text format         #
+#########################################################################################
+
+# trace of the request running in the current thread / asyncio task (None = not traced)
+current_trace = contextvars.ContextVar('palm_trace', default=None)
+
+# returned by stage() when nothing is traced
+NO_TRACE = nullcontext()
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# current resident set size of the process in bytes (0 where /proc is not available)
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+class Trace:
+    """Stage timings and counters of one request
+
+    stages : list of {'stage', 'wall', 'cpu', 'rss_delta', 'alloc_delta'} in the order the stages ended,
+        times in seconds, memory deltas in bytes (alloc_delta only when tracemalloc is running)
+    counters : counter name -> value
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.counters = {}
+
+    def add_count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # add the stages and counters of another trace, e.g. one recorded in a worker process
+    def merge(self, other):
+        self.stages.extend(other.stages)
+        for name, value in other.counters.items():
+            self.add_count(name, value)
+
+    def to_dict(self):
+        return {'stages': self.stages, 'counters': self.counters}
+
+class StageTimer:
+    """Context manager recording one stage into a trace"""
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.alloc = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.rss = rss_bytes()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record = {'stage': self.name,
+                  'wall': time.perf_counter() - self.wall,
+                  'cpu': time.process_time() - self.cpu,
+                  'rss_delta': rss_bytes() - self.rss}
+        if self.alloc is not None and tracemalloc.is_tracing():
+            record['alloc_delta'] = tracemalloc.get_traced_memory()[0] - self.alloc
+        self.trace.stages.append(record)
+
+# time a block as the given stage of the current trace
+def stage(name):
+    trace = current_trace.get()
+    if trace is None:
+        return NO_TRACE
+    return StageTimer(trace, name)
+
+# add value to a counter of the current trace
+def add_count(name, value=1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_count(name, value)
+
+# add the stages and counters of another trace (e.g. returned by a worker process) to the current trace
+def merge(other):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.merge(other)
+
+# trace the block as one request, yields its Trace
+# registry : MetricsRegistry the trace is added to at the end of the block
+# trace_memory : also record Python allocation deltas (tracemalloc, slow)
+@contextmanager
+def tracing(registry=None, trace_memory=False):
+    trace = Trace()
+    token = current_trace.set(trace)
+    started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    try:
+        yield trace
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        current_trace.reset(token)
+        if registry is not None:
+            registry.observe(trace)
+
+class MetricsRegistry:
+    """Totals of the traced requests of a process, exported in Prometheus text format
+
+    buckets : upper bounds (seconds) of the stage latency histogram
+    """
+
+    def __init__(self, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        # stage -> [bucket counts..., count, wall sum, cpu sum, rss growth sum]
+        self.stages = {}
+        self.counters = {}
+
+    def observe(self, trace):
+        with self.lock:
+            self.num_requests += 1
+            for record in trace.stages:
+                stats = self.stages.setdefault(record['stage'], [0] * len(self.buckets) + [0, 0.0, 0.0, 0])
+                for i, bound in enumerate(self.buckets):
+                    if record['wall'] <= bound:
+                        stats[i] += 1
+                n = len(self.buckets)
+                stats[n] += 1
+                stats[n + 1] += record['wall']
+                stats[n + 2] += record['cpu']
+                stats[n + 3] += max(record['rss_delta'], 0)
+            for name, value in trace.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def prometheus_text(self):
+        n = len(self.buckets)
+        with self.lock:
+            out = ['# HELP palm_requests_total Traced requests.',
+                   '# TYPE palm_requests_total counter',
+                   'palm_requests_total {}'.format(self.num_requests),
+                   '# HELP palm_stage_seconds Wall time of pipeline stages.',
+                   '# TYPE palm_stage_seconds histogram']
+            for name, stats in sorted(self.stages.items()):
+                for bound, num in zip(self.buckets, stats):
+                    out.append('palm_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, bound, num))
+                out.append('palm_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stats[n]))
+                out.append('palm_stage_seconds_sum{{stage="{}"}} {}'.format(name, stats[n + 1]))
+                out.append('palm_stage_seconds_count{{stage="{}"}} {}'.format(name, stats[n]))
+            out += ['# HELP palm_stage_cpu_seconds_total CPU time of pipeline stages (whole process).',
+                    '# TYPE palm_stage_cpu_seconds_total counter']
+            out += ['palm_stage_cpu_seconds_total{{stage="{}"}} {}'.format(name, stats[n + 2]) for name, stats in sorted(self.stages.items())]
+            out += ['# HELP palm_stage_rss_growth_bytes_total Resident memory growth during pipeline stages.',
+                    '# TYPE palm_stage_rss_growth_bytes_total counter']
+            out += ['palm_stage_rss_growth_bytes_total{{stage="{}"}} {}'.format(name, stats[n + 3]) for name, stats in sorted(self.stages.items())]
+            for name, value in sorted(self.counters.items()):
+                out += ['# TYPE palm_{}_total counter'.format(name),
+                        'palm_{}_total {}'.format(name, value)]
+        return '\n'.join(out) + '\n'
@@ -75,6 +75,7 @@ class OutConv(nn.Module):
 class ContextFusion(nn.Module):
     def __init__(self, channels):
         super().__init__()
+        self.maxpool = nn.MaxPool2d(2)
         self.context_modeling = nn.Sequential(
             nn.Conv2d(channels, channels, kernel_size=1),
             nn.Softmax2d()
@@ -92,26 +93,33 @@ class ContextFusion(nn.Module):
         )
 
     def forward(self, x):
-        x1 = nn.MaxPool2d(2)(x)
+        x1 = self.maxpool(x)
         x2 = self.context_modeling(x1) * x1
         return self.context_transform1(x2) * x1 + self.context_transform2(x2)
 
+# channels of a layer of width channels in a UNet scaled by width_mult, a multiple of 8 (vectorizes better on CPU)
+def scaled_width(channels, width_mult):
+    return max(8, int(round(channels * width_mult / 8)) * 8)
+
 class UNet(nn.Module):
-    def __init__(self, n_channels, n_classes):
+    # width_mult : scales the channels of every layer (1 = the original 64-128-256-512 widths), see prune.py
+    def __init__(self, n_channels, n_classes, width_mult=1.0):
         super(UNet, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
-
-        self.inc = DoubleConv(n_channels, 64)
-        self.down1 = Down(64, 128)
-        self.down2 = Down(128, 256)
-        self.down3 = Down(256, 512)
-        self.cfm = ContextFusion(512)
-        self.up1 = Up(1024, 512 // 2)
-        self.up2 = Up(512, 256 // 2)
-        self.up3 = Up(256, 128 // 2)
-        self.up4 = Up(128, 64)
-        self.outc = OutConv(64, n_classes)
+        self.width_mult = width_mult
+        w1, w2, w3, w4 = [scaled_width(channels, width_mult) for channels in [64, 128, 256, 512]]
+
+        self.inc = DoubleConv(n_channels, w1)
+        self.down1 = Down(w1, w2)
+        self.down2 = Down(w2, w3)
+        self.down3 = Down(w3, w4)
+        self.cfm = ContextFusion(w4)
+        self.up1 = Up(2 * w4, w3)
+        self.up2 = Up(2 * w3, w2)
+        self.up3 = Up(2 * w2, w1)
+        self.up4 = Up(2 * w1, w1)
+        self.outc = OutConv(w1, n_classes)
 
     def forward(self, x):
         x1 = self.inc(x)
@@ -124,4 +132,14 @@ class UNet(nn.Module):
         x = self.up3(x, x2)
         x = self.up4(x, x1)
         logits = self.outc(x)
-        return logits
\ No newline at end of file
+        return logits
+
+# load a UNet checkpoint : a state_dict (the original checkpoints) or {'width_mult', 'state_dict'} (pruned, see prune.py)
+def load_unet(path_to_model, device=torch.device('cpu')):
+    checkpoint = torch.load(path_to_model, map_location=device)
+    width_mult = 1.0
+    if 'state_dict' in checkpoint:
+        width_mult, checkpoint = checkpoint.get('width_mult', 1.0), checkpoint['state_dict']
+    net = UNet(n_channels=3, n_classes=1, width_mult=width_mult)
+    net.load_state_dict(checkpoint)
+    return net
@@ -0,0 +1,74 @@
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+from model import *
+from onnx_net import OnnxNet
+from backend import mask_iou, load_samples
+from detection import detect_batch
+
+#########################################################################################
+# ONNX export of the UNet (ContextFusion and the bilinear Up blocks included)           #
+# - the batch, height and width dimensions are dynamic, so one file serves batched      #
+#   requests, other resize_values and the tiles of detection.detect_tiled               #
+# - the parity check runs the torch and ONNX Runtime nets on random inputs of several   #
+#   shapes (max logit difference) and on sample palms (mask IoU, latency)              #
+# serve it with PalmSession('checkpoint/unet.onnx') (or --model in the CLIs), no torch  #
+#########################################################################################
+
+OPSET = 17
+
+# export net to path_to_onnx, size : height and width of the example input used for the export
+def export_onnx(net, path_to_onnx, size=256):
+    # the TorchScript-based exporter (dynamo=False) : the torch.export-based one needs onnxscript
+    torch.onnx.export(net.eval(), (torch.zeros((1, 3, size, size)),), path_to_onnx,
+                      input_names=['image'], output_names=['logits'], opset_version=OPSET, dynamo=False,
+                      dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch', 2: 'height', 3: 'width'}})
+
+# max absolute logit difference between the torch net and the ONNX net for each (batch, height, width) shape
+def check_parity(net, onnx_net, shapes=((1, 256, 256), (4, 256, 256), (2, 512, 512)), seed=0):
+    rng = np.random.default_rng(seed)
+    differences = {}
+    for shape in shapes:
+        batch = rng.random((shape[0], 3, shape[1], shape[2]), dtype=np.float32)
+        with torch.inference_mode():
+            reference = net(torch.from_numpy(batch)).numpy()
+        differences[shape] = float(np.abs(onnx_net(batch) - reference).max())
+    return differences
+
+def median_latency(net, samples, repeat=5):
+    detect_batch(net, samples[:1])  # warm up
+    latencies = []
+    for _ in range(repeat):
+        for sample in samples:
+            start = time.perf_counter()
+            detect_batch(net, [sample])
+            latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export the UNet to ONNX and check it against the torch net')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint (full or pruned)')
+    parser.add_argument('--output', default='checkpoint/unet.onnx')
+    parser.add_argument('--resize_value', type=int, default=256)
+    parser.add_argument('--images', nargs='*', default=glob.glob('input/*.jpg'), help='sample palm images of the IoU and latency comparison')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest accepted logit difference')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    net = load_unet(args.model).eval()
+    export_onnx(net, args.output, args.resize_value)
+    onnx_net = OnnxNet(args.output)
+    print('exported {}'.format(args.output))
+
+    differences = check_parity(net, onnx_net)
+    for shape, difference in differences.items():
+        print('batch {} {}x{} : max logit difference {:.2e}'.format(*shape, difference))
+    samples = load_samples(args.images, args.resize_value)
+    if samples:
+        ious = [mask_iou(a, b) for a, b in zip(detect_batch(net, samples), detect_batch(onnx_net, samples))]
+        print('mask IoU on {} palms : mean {:.4f}, min {:.4f}'.format(len(samples), np.mean(ious), np.min(ious)))
+        print('latency : torch {:.1f} ms, onnxruntime {:.1f} ms'.format(median_latency(net, samples, args.repeat) * 1000, median_latency(onnx_net, samples, args.repeat) * 1000))
+    if max(differences.values()) > args.tolerance:
+        raise SystemExit('parity check failed : logit difference above {}'.format(args.tolerance))
@@ -0,0 +1,22 @@
+import numpy as np
+
+# ONNX Runtime inference of the UNet, without torch (see onnx_export.py for the export)
+
+class OnnxNet:
+    """UNet exported to ONNX, run with ONNX Runtime's CPU provider
+
+    called like the torch UNet but on numpy arrays : (N,3,H,W) float32 -> (N,1,H,W) float32 logits
+    """
+
+    # num_threads : intra-op threads of ONNX Runtime (None = its default, one per core)
+    def __init__(self, path_to_model, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path_to_model, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
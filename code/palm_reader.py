@@ -0,0 +1,131 @@
+import os
+from collections import namedtuple
+import numpy as np
+import cv2
+from session import *
+from cache import *
+from tools import *
+from rectification import *
+from detection import *
+from classification import *
+from measurement import *
+from metrics import stage, add_count
+from artifacts import *
+
+# result of reading one palm image
+# warped / warped_clean / warped_mini : BGR arrays, palmline_img : line mask (H,W)
+# lines : [heart, head, life] at the size of palmline_img (session.detect_size), im : annotated PIL image, contents : texts for each line
+# M, landmarks : homography and hand landmarks of the rectification (see rectification.rectify_palm)
+PalmResult = namedtuple('PalmResult', ['warped', 'warped_clean', 'warped_mini', 'palmline_img', 'lines', 'im', 'contents', 'M', 'landmarks'], defaults=(None, None))
+
+# JSON-serializable summary of a PalmResult
+# lines : [heart, head, life] as lists of [y, x] pixels (None if not found), contents : texts for each line
+def result_to_dict(result):
+    return {
+        'lines': [None if line is None else np.asarray(line)[:, :2].tolist() for line in result.lines],
+        'contents': result.contents,
+    }
+
+# artifacts saved by default (see artifacts.ARTIFACT_FILES), 'result' is the rendered result
+SAVED_ARTIFACTS = ['warped', 'warped_mini', 'warped_clean', 'palmline_img', 'result']
+
+class PalmReader:
+    """Runs the whole pipeline on in-memory images, files are written only when asked"""
+
+    # session : PalmSession holding the loaded UNet and Hands context
+    # cache : optional ResultCache, used by read_bytes
+    # result_format : format of the saved result, one of render.FORMATS ('json' = texts only, nothing rendered)
+    # saved : artifacts written to results_dir, artifacts nothing asks for are never computed
+    def __init__(self, session, cache=None, result_format='jpg', saved=SAVED_ARTIFACTS):
+        self.session = session
+        self.cache = cache
+        self.result_format = result_format
+        self.saved = saved
+        self.net = session.net
+        self.hands = session.hands
+        self.resize_value = session.resize_value
+        self.device = session.device
+
+    # lazy artifacts of one BGR input image, see artifacts.py
+    def artifacts(self, image):
+        return PalmArtifacts(self, image)
+
+    # line masks of clean warped palms at session.detect_size, the UNet runs once on the whole batch (or its tiles)
+    def detect(self, warped_cleans):
+        imgs = [preprocess(cv2.cvtColor(warped_clean, cv2.COLOR_BGR2RGB), self.session.detect_size) for warped_clean in warped_cleans]
+        return self.session.detect(imgs)
+
+    # image : BGR array of the input palm
+    # results_dir : if given, save the artifacts in self.saved there
+    # returns PalmResult, or None if the palm could not be rectified
+    def read(self, image, results_dir=None):
+        return self.read_batch([image], [results_dir])[0]
+
+    # data : encoded bytes of the input palm (jpeg, png, heic, ...)
+    # on a cache hit, rectification, detection and classification are skipped
+    def read_bytes(self, data, results_dir=None):
+        with stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            raise ValueError('cannot decode the image')
+        if self.cache is None:
+            return self.read(image, results_dir)
+
+        with stage('cache_lookup'):
+            key = cache_key(data, self.session)
+            entry = self.cache.get(key)
+        add_count('cache_hits' if entry is not None else 'cache_misses')
+        if entry is None:
+            result = self.read(image, results_dir)
+            if result is None:
+                self.cache.put(key, {'M': None, 'landmarks': None, 'palmline_img': None, 'lines': [None, None, None]})
+            else:
+                self.cache.put(key, {'M': result.M, 'landmarks': result.landmarks, 'palmline_img': result.palmline_img, 'lines': result.lines})
+            return result
+        if entry['M'] is None:
+            return None
+
+        # 4. Length measurement with the cached homography and lines
+        artifacts = self.artifacts(image)
+        artifacts.put('homography', (entry['M'], entry['landmarks']))
+        artifacts.put('palmline_img', entry['palmline_img'])
+        artifacts.put('lines', entry['lines'])
+        return self.finish(artifacts, results_dir)
+
+    # read N palm images, the UNet runs once on the whole batch
+    # results_dirs : optional list with a results_dir (or None) for each image
+    # returns a list of PalmResult (None for palms that could not be rectified)
+    def read_batch(self, images, results_dirs=None):
+        # 1. Palm image rectification
+        items = [self.artifacts(image) for image in images]
+        rectified = [artifacts for artifacts in items if artifacts.get('warped_clean') is not None]
+
+        # 2. Principal line detection
+        with stage('detect'):
+            palmline_imgs = self.detect([artifacts.get('warped_clean') for artifacts in rectified]) if rectified else []
+        for artifacts, palmline_img in zip(rectified, palmline_imgs):
+            artifacts.put('palmline_img', palmline_img)
+
+        # 3-4. Line classification and length measurement
+        results_dirs = results_dirs or [None] * len(images)
+        return [self.finish(artifacts, results_dir) for artifacts, results_dir in zip(items, results_dirs)]
+
+    # classify and measure (computing what is missing), save, returns PalmResult or None
+    def finish(self, artifacts, results_dir=None):
+        if artifacts.get('measurement') is None:
+            return None
+        if results_dir is not None:
+            self.save(artifacts, results_dir)
+        get = artifacts.get
+        return PalmResult(get('warped'), artifacts.computed('warped_clean'), get('warped_mini'), get('palmline_img'), get('lines'),
+                          get('im'), get('contents'), get('M'), get('landmarks'))
+
+    # save the artifacts in self.saved with the same names as read_palm.py
+    def save(self, artifacts, results_dir):
+        with stage('save'):
+            os.makedirs(results_dir, exist_ok=True)
+            for name in self.saved:
+                if name == 'result':
+                    save_result(artifacts.get('im'), artifacts.get('contents'), self.resize_value, os.path.join(results_dir, 'result.' + self.result_format))
+                elif artifacts.get(name) is not None:
+                    cv2.imwrite(os.path.join(results_dir, ARTIFACT_FILES[name]), artifacts.get(name))
@@ -0,0 +1,174 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+from rectification import create_hands
+from classification import rectify_mask
+
+#########################################################################################
+# PLSU dataset preparation                                                             #
+# - rectifies the line mask of every PLSU image on a process pool (one Hands per worker)#
+# - stores the rectified masks in NPZ shards of shard_size masks                       #
+#   (shard_XXXXX.npz with 'idx' (N,) and 'masks' (N,size,size) uint8)                  #
+# - records every image in manifest.jsonl, a rerun skips the images already recorded   #
+#########################################################################################
+
+# Hands context of the current worker process, created once by init_worker
+hands = None
+
+def init_worker():
+    global hands
+    cv2.setNumThreads(1)
+    hands = create_hands()
+
+# worker : rectify the mask of one PLSU image, returns (idx, mask or None, error or None)
+def rectify_one(task):
+    idx, path_to_image, path_to_mask, size = task
+    try:
+        image = cv2.imread(path_to_image)
+        image_mask = cv2.imread(path_to_mask, cv2.IMREAD_GRAYSCALE)
+        if image is None or image_mask is None:
+            return idx, None, 'cannot read the image or its mask'
+        return idx, rectify_mask(image, image_mask, hands, size), None
+    except Exception as e:
+        return idx, None, repr(e)
+
+# (idx, image path, mask path) of the PLSU images having a mask, in idx order
+def list_plsu(plsu_dir):
+    samples = []
+    for path_to_image in glob.glob(os.path.join(plsu_dir, '[Ii]mg', 'image*.jpg')):
+        idx = int(re.search(r'image(\d+)', os.path.basename(path_to_image)).group(1))
+        path_to_mask = os.path.join(plsu_dir, 'Mask', 'image{}.png'.format(idx))
+        if os.path.exists(path_to_mask):
+            samples.append((idx, path_to_image, path_to_mask))
+    return sorted(samples)
+
+# manifest records of a dataset directory
+def read_manifest(dataset_dir):
+    path = os.path.join(dataset_dir, 'manifest.jsonl')
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# iterate over the (idx, mask) of a prepared dataset, one shard in memory at a time
+def iter_masks(dataset_dir):
+    for path in sorted(glob.glob(os.path.join(dataset_dir, 'shard_*.npz'))):
+        with np.load(path) as shard:
+            for idx, mask in zip(shard['idx'], shard['masks']):
+                yield int(idx), mask
+
+# (shard name, offset) of each idx stored in the shards of a prepared dataset (only the idx arrays are read)
+def shard_index(dataset_dir):
+    index = {}
+    for path in sorted(glob.glob(os.path.join(dataset_dir, 'shard_*.npz'))):
+        with np.load(path) as shard:
+            for offset, idx in enumerate(shard['idx'].tolist()):
+                index[idx] = os.path.basename(path), offset
+    return index
+
+class ShardWriter:
+    """Buffers rectified masks and writes them as NPZ shards, then records them in the manifest
+
+    masks are recorded only once their shard is on disk, so an interrupted run loses at most one shard
+    (a shard on disk whose records were not written yet is recorded by recover)
+    """
+
+    def __init__(self, dataset_dir, shard_size):
+        self.dataset_dir = dataset_dir
+        self.shard_size = shard_size
+        self.num_shards = len(glob.glob(os.path.join(dataset_dir, 'shard_*.npz')))
+        self.idx = []
+        self.masks = []
+        self.manifest = open(os.path.join(dataset_dir, 'manifest.jsonl'), 'a', encoding='utf-8')
+
+    def record(self, record):
+        self.manifest.write(json.dumps(record) + '\n')
+        self.manifest.flush()
+
+    def add(self, idx, mask):
+        self.idx.append(idx)
+        self.masks.append(mask)
+        if len(self.masks) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.masks:
+            return
+        name = 'shard_{:05d}.npz'.format(self.num_shards)
+        path = os.path.join(self.dataset_dir, name)
+        # write then rename, so a shard on disk is always complete
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, idx=np.array(self.idx), masks=np.stack(self.masks))
+        os.replace(path + '.tmp', path)
+        for offset, idx in enumerate(self.idx):
+            self.record({'idx': idx, 'status': 'ok', 'shard': name, 'offset': offset})
+        self.num_shards += 1
+        self.idx, self.masks = [], []
+
+    # record the masks of the shards on disk missing from the manifest (a run interrupted between
+    # the rename of a shard and its records), so they are not rectified again into a duplicate shard
+    # status : idx -> last manifest status, updated ; returns the number of recovered masks
+    def recover(self, status):
+        recovered = 0
+        for idx, (name, offset) in shard_index(self.dataset_dir).items():
+            if status.get(idx) != 'ok':
+                self.record({'idx': idx, 'status': 'ok', 'shard': name, 'offset': offset})
+                status[idx] = 'ok'
+                recovered += 1
+        return recovered
+
+    def close(self):
+        self.flush()
+        self.manifest.close()
+
+# rectify every PLSU image not yet in the manifest of dataset_dir
+def prepare_dataset(plsu_dir, dataset_dir, workers=None, shard_size=256, size=1024, retry_failed=False):
+    os.makedirs(dataset_dir, exist_ok=True)
+    status = {record['idx']: record['status'] for record in read_manifest(dataset_dir)}  # the last record of an image wins
+    writer = ShardWriter(dataset_dir, shard_size)
+    recovered = writer.recover(status)
+    if recovered:
+        print('{} masks recovered from unrecorded shards'.format(recovered))
+    done = {idx for idx, st in status.items() if st == 'ok' or not retry_failed}
+    tasks = [(idx, path_to_image, path_to_mask, size) for idx, path_to_image, path_to_mask in list_plsu(plsu_dir) if idx not in done]
+    print('{} images to rectify ({} already done)'.format(len(tasks), len(done)))
+
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    counts = {'ok': 0, 'not_detected': 0, 'error': 0}
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(workers, init_worker) as pool:
+            for num_done, (idx, mask, error) in enumerate(pool.imap_unordered(rectify_one, tasks, chunksize=4), 1):
+                if error is not None:
+                    counts['error'] += 1
+                    writer.record({'idx': idx, 'status': 'error', 'error': error})
+                elif mask is None:
+                    counts['not_detected'] += 1
+                    writer.record({'idx': idx, 'status': 'not_detected'})
+                else:
+                    counts['ok'] += 1
+                    writer.add(idx, mask)
+                if num_done % 100 == 0:
+                    print('[{}/{}] {:.1f} images/sec'.format(num_done, len(tasks), num_done / (time.perf_counter() - start)), file=sys.stderr)
+    finally:
+        writer.close()
+    print('{} rectified, {} without hand, {} errors in {:.1f}s'.format(counts['ok'], counts['not_detected'], counts['error'], time.perf_counter() - start))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rectify the PLSU line masks in parallel into NPZ shards')
+    parser.add_argument('--plsu_dir', default='./PLSU/PLSU', help='directory with the img/ (or Img/) and Mask/ folders')
+    parser.add_argument('--dataset_dir', default='./line_dataset', help='output directory of the shards and the manifest')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard_size', type=int, default=256, help='masks per shard')
+    parser.add_argument('--size', type=int, default=1024, help='size of the rectified masks')
+    parser.add_argument('--retry_failed', action='store_true', help='rectify again the images recorded as failed')
+    args = parser.parse_args()
+    prepare_dataset(args.plsu_dir, args.dataset_dir, args.workers, args.shard_size, args.size, args.retry_failed)
@@ -0,0 +1,198 @@
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import cv2
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model import *
+from backend import mask_iou, load_samples
+from detection import detect_batch
+
+#########################################################################################
+# Structured channel pruning of the UNet                                                #
+# (1) the filters of every layer are ranked by |BatchNorm scale| (or L1 norm of the     #
+#     filter), and the best ones are kept to build a UNet(width_mult=...)               #
+#     the channels of a stage are kept together everywhere they are used (next stage,   #
+#     skip connection of the decoder, ContextFusion), so the pruned net is a plain UNet #
+# (2) optional fine-tuning on local PLSU images, the pruned net learns to reproduce     #
+#     the outputs of the original net (so LINE_THRESHOLD keeps its meaning)             #
+# (3) FLOPs, parameters, latency and mask IoU against the original on sample palms     #
+#########################################################################################
+
+CRITERIA = ['bn', 'l1']
+
+# indices (sorted) of the num_kept output channels of a conv with the best scores
+# conv_weight : (out, in, k, k), bn_weight : (out,) BatchNorm scale after the conv or None
+def rank_channels(conv_weight, bn_weight, num_kept, criterion='bn'):
+    if criterion == 'bn' and bn_weight is not None:
+        scores = bn_weight.abs()
+    else:
+        scores = conv_weight.abs().sum(dim=(1, 2, 3))
+    return torch.sort(torch.argsort(scores, descending=True)[:num_kept]).values
+
+# copy the kept output channels (out_idx) and input channels (in_idx) of a conv (and its bias)
+def prune_conv(state_dict, pruned, prefix, in_idx, out_idx):
+    pruned[prefix + 'weight'] = state_dict[prefix + 'weight'][out_idx][:, in_idx].clone()
+    if prefix + 'bias' in state_dict:
+        pruned[prefix + 'bias'] = state_dict[prefix + 'bias'][out_idx].clone()
+
+def prune_bn(state_dict, pruned, prefix, idx):
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        pruned[prefix + name] = state_dict[prefix + name][idx].clone()
+    pruned[prefix + 'num_batches_tracked'] = state_dict[prefix + 'num_batches_tracked'].clone()
+
+# prune a DoubleConv (conv, bn, relu, conv, bn, relu) to mid and out channels, returns the kept output channels
+def prune_double_conv(state_dict, pruned, prefix, in_idx, mid, out, criterion):
+    mid_idx = rank_channels(state_dict[prefix + '0.weight'], state_dict[prefix + '1.weight'], mid, criterion)
+    prune_conv(state_dict, pruned, prefix + '0.', in_idx, mid_idx)
+    prune_bn(state_dict, pruned, prefix + '1.', mid_idx)
+    out_idx = rank_channels(state_dict[prefix + '3.weight'], state_dict[prefix + '4.weight'], out, criterion)
+    prune_conv(state_dict, pruned, prefix + '3.', mid_idx, out_idx)
+    prune_bn(state_dict, pruned, prefix + '4.', out_idx)
+    return out_idx
+
+# state_dict of UNet(width_mult) holding the best channels of a full width UNet state_dict
+def prune_unet(state_dict, width_mult, criterion='bn'):
+    w1, w2, w3, w4 = [scaled_width(channels, width_mult) for channels in [64, 128, 256, 512]]
+    c1, c2, c3, c4 = [state_dict[name].shape[0] for name in ['inc.double_conv.3.weight', 'down1.maxpool_conv.1.double_conv.3.weight',
+                                                           'down2.maxpool_conv.1.double_conv.3.weight', 'down3.maxpool_conv.1.double_conv.3.weight']]
+    pruned = {}
+    # encoder
+    x1 = prune_double_conv(state_dict, pruned, 'inc.double_conv.', torch.arange(state_dict['inc.double_conv.0.weight'].shape[1]), w1, w1, criterion)
+    x2 = prune_double_conv(state_dict, pruned, 'down1.maxpool_conv.1.double_conv.', x1, w2, w2, criterion)
+    x3 = prune_double_conv(state_dict, pruned, 'down2.maxpool_conv.1.double_conv.', x2, w3, w3, criterion)
+    x4 = prune_double_conv(state_dict, pruned, 'down3.maxpool_conv.1.double_conv.', x3, w4, w4, criterion)
+
+    # ContextFusion : its output is multiplied and added channel by channel with its input, so it keeps the channels x4
+    # (the hidden channels of its two transforms are ranked by L1 norm, there is no BatchNorm)
+    prune_conv(state_dict, pruned, 'cfm.context_modeling.0.', x4, x4)
+    for transform in ['cfm.context_transform1.', 'cfm.context_transform2.']:
+        hidden = rank_channels(state_dict[transform + '0.weight'][:, x4], None, w4, 'l1')
+        prune_conv(state_dict, pruned, transform + '0.', x4, hidden)
+        prune_conv(state_dict, pruned, transform + '2.', hidden, x4)
+
+    # decoder : the input of each Up is cat([skip, upsampled]), so the upsampled channels are offset by the skip width
+    x = prune_double_conv(state_dict, pruned, 'up1.conv.double_conv.', torch.cat([x4, c4 + x4]), w4, w3, criterion)
+    x = prune_double_conv(state_dict, pruned, 'up2.conv.double_conv.', torch.cat([x3, c3 + x]), w3, w2, criterion)
+    x = prune_double_conv(state_dict, pruned, 'up3.conv.double_conv.', torch.cat([x2, c2 + x]), w2, w1, criterion)
+    x = prune_double_conv(state_dict, pruned, 'up4.conv.double_conv.', torch.cat([x1, c1 + x]), w1, w1, criterion)
+    prune_conv(state_dict, pruned, 'outc.conv.', x, torch.arange(state_dict['outc.conv.weight'].shape[0]))
+    return pruned
+
+# pruned UNet(width_mult) from a full width UNet
+def prune(net, width_mult, criterion='bn'):
+    pruned = UNet(net.n_channels, net.n_classes, width_mult)
+    pruned.load_state_dict(prune_unet(net.state_dict(), width_mult, criterion))
+    return pruned.eval()
+
+# multiply-accumulates of the convolutions for one (3,size,size) input, counted with forward hooks
+def count_macs(net, size=256):
+    macs = []
+    def hook(module, inputs, output):
+        macs.append(output.numel() * module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1])
+    handles = [module.register_forward_hook(hook) for module in net.modules() if isinstance(module, nn.Conv2d)]
+    try:
+        with torch.inference_mode():
+            net(torch.zeros((1, 3, size, size)))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sum(macs)
+
+def median_latency(net, size=256, repeat=10):
+    x = torch.zeros((1, 3, size, size))
+    durations = []
+    with torch.inference_mode():
+        net(x)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            net(x)
+            durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+# rectified PLSU images of evaluate.py's eval_dir (prepared from plsu_dir if missing) as uint8 (N,size,size,3) RGB
+def load_plsu_images(plsu_dir, eval_dir, size=256, limit=None):
+    from tools import clean_background
+    from evaluate import prepare_pairs
+    indices = prepare_pairs(plsu_dir, eval_dir, limit=limit)
+    images = []
+    for idx in indices:
+        image = cv2.imread(os.path.join(eval_dir, 'image{}.jpg'.format(idx)))
+        images.append(cv2.resize(cv2.cvtColor(clean_background(image), cv2.COLOR_BGR2RGB), (size, size), interpolation=cv2.INTER_NEAREST))
+    return np.stack(images)
+
+# fine-tune the pruned net to reproduce the outputs of the original net (distillation) on images (N,H,W,3) uint8
+# the outputs of the original net are computed once, images are flipped horizontally at random
+def finetune(net, teacher, images, epochs=5, batch_size=8, lr=1e-4, seed=0):
+    inputs = torch.from_numpy(images).permute(0, 3, 1, 2)
+    with torch.inference_mode():
+        targets = torch.cat([teacher(inputs[i:i+batch_size].float() / 255) for i in range(0, len(inputs), batch_size)])
+    generator = torch.Generator().manual_seed(seed)
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
+    net.train()
+    for epoch in range(epochs):
+        order = torch.randperm(len(inputs), generator=generator)
+        total = 0.0
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i+batch_size]
+            x, y = inputs[batch].float() / 255, targets[batch]
+            if torch.rand(1, generator=generator).item() < 0.5:
+                x, y = x.flip(3), y.flip(3)
+            loss = F.mse_loss(net(x), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(batch)
+        print('epoch {}/{} : loss {:.6f}'.format(epoch + 1, epochs, total / len(order)))
+    return net.eval()
+
+# FLOPs (2 x multiply-accumulates), parameters, latency and mask IoU against the reference masks
+def report(name, net, samples, reference_masks, size=256, repeat=10):
+    ious = [mask_iou(mask, reference) for mask, reference in zip(detect_batch(net, samples) if samples else [], reference_masks)]
+    return {'model': name,
+            'gflops': 2 * count_macs(net, size) / 1e9,
+            'params_m': sum(p.numel() for p in net.parameters()) / 1e6,
+            'latency_ms': median_latency(net, size, repeat) * 1000,
+            'mean_iou': float(np.mean(ious)) if ious else float('nan'),
+            'min_iou': float(np.min(ious)) if ious else float('nan')}
+
+def print_report(rows):
+    print('{:<28} {:>8} {:>10} {:>12} {:>9} {:>9}'.format('model', 'GFLOPs', 'params(M)', 'latency(ms)', 'mean IoU', 'min IoU'))
+    for row in rows:
+        print('{:<28} {:>8.2f} {:>10.2f} {:>12.1f} {:>9.4f} {:>9.4f}'.format(row['model'], row['gflops'], row['params_m'], row['latency_ms'], row['mean_iou'], row['min_iou']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prune the UNet channels into slimmer checkpoints and compare them with the original')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the original checkpoint')
+    parser.add_argument('--width_mults', type=float, nargs='+', default=[0.5, 0.75], help='width multipliers of the pruned UNets')
+    parser.add_argument('--criterion', default='bn', choices=CRITERIA, help='rank the filters by BatchNorm scale or L1 norm')
+    parser.add_argument('--output_dir', default='checkpoint', help='pruned checkpoints are written as unet_w<width_mult>.pth')
+    parser.add_argument('--images', nargs='+', default=glob.glob('input/*.jpg'), help='sample palm images of the IoU comparison')
+    parser.add_argument('--resize_value', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=10, help='timed forward passes')
+    parser.add_argument('--finetune_epochs', type=int, default=0, help='fine-tune each pruned net on local PLSU images (0 = no fine-tuning)')
+    parser.add_argument('--plsu_dir', default='./PLSU/PLSU', help='directory with the img/ (or Img/) and Mask/ folders')
+    parser.add_argument('--eval_dir', default='./eval_data', help='rectified PLSU images, shared with evaluate.py')
+    parser.add_argument('--limit', type=int, default=None, help='fine-tune on the first PLSU images only')
+    args = parser.parse_args()
+
+    net = load_unet(args.model).eval()
+    samples = load_samples(args.images, args.resize_value)
+    reference_masks = detect_batch(net, samples) if samples else []
+    rows = [report('original', net, samples, reference_masks, args.resize_value, args.repeat)]
+    images = load_plsu_images(args.plsu_dir, args.eval_dir, args.resize_value, args.limit) if args.finetune_epochs > 0 else None
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for width_mult in args.width_mults:
+        pruned = prune(net, width_mult, args.criterion)
+        rows.append(report('w{} {}'.format(width_mult, args.criterion), pruned, samples, reference_masks, args.resize_value, args.repeat))
+        if images is not None:
+            pruned = finetune(pruned, net, images, args.finetune_epochs)
+            rows.append(report('w{} {} + finetune'.format(width_mult, args.criterion), pruned, samples, reference_masks, args.resize_value, args.repeat))
+        path = os.path.join(args.output_dir, 'unet_w{}.pth'.format(width_mult))
+        torch.save({'width_mult': width_mult, 'state_dict': pruned.state_dict()}, path)
+        print('saved {}'.format(path))
+    print_report(rows)
@@ -1,55 +1,60 @@
 import os
+import json
 import argparse
 from tools import *
-from model import *
-from rectification import *
-from detection import *
-from classification import *
-from measurement import *
-
-def main(input):
+from palm_reader import *
+from batch import list_images, read_batch
+from metrics import tracing
+from render import FORMATS
+
+# trace : print the stage timings and counters of the run as JSON
+# result_format : format of results/result.*, see render.FORMATS
+# saved : artifacts written to results/, see artifacts.ARTIFACT_FILES
+# detect_size, memory_limit : tiled line detection, see session.PalmSession
+def main(input, trace=False, result_format='jpg', saved=SAVED_ARTIFACTS, detect_size=None, memory_limit=TILE_MEMORY_LIMIT):
     path_to_input_image = 'input/{}'.format(input)
 
     results_dir = './results'
     os.makedirs(results_dir, exist_ok=True)
 
     resize_value = 256
-    path_to_clean_image = 'results/palm_without_background.jpg'
-    path_to_warped_image = 'results/warped_palm.jpg'
-    path_to_warped_image_clean = 'results/warped_palm_clean.jpg'
-    path_to_warped_image_mini = 'results/warped_palm_mini.jpg'
-    path_to_warped_image_clean_mini = 'results/warped_palm_clean_mini.jpg'
-    path_to_palmline_image = 'results/palm_lines.png'
     path_to_model = 'checkpoint/checkpoint_aug_epoch70.pth'
-    path_to_result = 'results/result.jpg'
 
-    # 0. Preprocess image
-    remove_background(path_to_input_image, path_to_clean_image)
+    # 0. Load image
+    image = load_image(path_to_input_image)
 
-    # 1. Palm image rectification
-    warp_result = warp(path_to_input_image, path_to_warped_image)
-    if warp_result is None:
+    # 1-5. Rectification, detection, classification, measurement and saving, all in memory
+    with PalmSession(path_to_model, resize_value, detect_size=detect_size, memory_limit=memory_limit) as session:
+        with tracing() as request_trace:
+            result = PalmReader(session, result_format=result_format, saved=saved).read(image, results_dir)
+    if result is None:
         print_error()
-    else:
-        remove_background(path_to_warped_image, path_to_warped_image_clean)
-        resize(path_to_warped_image, path_to_warped_image_clean, path_to_warped_image_mini, path_to_warped_image_clean_mini, resize_value)
-
-        # 2. Principal line detection
-        net = UNet(n_channels=3, n_classes=1)
-        net.load_state_dict(torch.load(path_to_model, map_location=torch.device('cpu')))
-        detect(net, path_to_warped_image_clean, path_to_palmline_image, resize_value)
-
-        # 3. Line classification
-        lines = classify(path_to_palmline_image)
-
-        # 4. Length measurement
-        im, contents = measure(path_to_warped_image_mini, lines)
-
-        # 5. Save result
-        save_result(im, contents, resize_value, path_to_result)
+    if trace:
+        print(json.dumps(request_trace.to_dict(), indent=2))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input', required=True, help='the path to the input')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', help='the path to the input')
+    inputs.add_argument('--input_dir', help='batch mode : directory of palm images')
+    inputs.add_argument('--manifest', help='batch mode : text file with one image path per line')
+    parser.add_argument('--output_dir', default='results/batch', help='batch mode : per-image outputs are written under this directory')
+    parser.add_argument('--jsonl', default='results/batch/results.jsonl', help='batch mode : records are appended to this file as images finish')
+    parser.add_argument('--workers', type=int, default=None, help='batch mode : number of worker processes (default: number of CPUs)')
+    parser.add_argument('--backend', default='eager', help='batch mode : UNet inference backend, see backend.py')
+    parser.add_argument('--no_images', action='store_true', help='batch mode : only write the JSONL records')
+    parser.add_argument('--cache_dir', default=None, help='batch mode : on-disk result cache directory')
+    parser.add_argument('--result_format', default='jpg', choices=sorted(FORMATS), help="format of the result, 'json' writes the texts without rendering")
+    parser.add_argument('--save', nargs='*', default=SAVED_ARTIFACTS, choices=sorted(ARTIFACT_FILES) + ['result'],
+                        help='artifacts to write (e.g. --save result --result_format json for the texts only)')
+    parser.add_argument('--trace', action='store_true', help='print (or add to each batch record) the stage timings and counters')
+    parser.add_argument('--detect_size', type=int, default=None, help='detect the lines at this size (e.g. 1024) with tiled inference')
+    parser.add_argument('--memory_limit_mb', type=float, default=512, help='UNet activation memory of one batch of tiles (per worker in batch mode)')
     args = parser.parse_args()
-    main(args.input)
\ No newline at end of file
+    memory_limit = int(args.memory_limit_mb * 1024 * 1024)
+    if args.input is not None:
+        main(args.input, args.trace, args.result_format, args.save, args.detect_size, memory_limit)
+    else:
+        paths = list_images(args.input_dir, args.manifest)
+        read_batch(paths, args.output_dir, args.jsonl, args.workers, backend=args.backend, saved=[] if args.no_images else args.save, cache_dir=args.cache_dir, trace=args.trace, result_format=args.result_format,
+                   detect_size=args.detect_size, memory_limit=memory_limit)
\ No newline at end of file
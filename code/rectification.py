@@ -1,58 +1,114 @@
+from contextlib import nullcontext
 import numpy as np
 import cv2
 import mediapipe as mp
+from tools import load_image
 
 # code reference: https://google.github.io/mediapipe/solutions/hands.html
 
 WARP_SUCCESS = 1
 
-def warp_image(path_to_image, path_to_warped_image):
-        # 7 landmark points (normalized)
-    pts_index = list(range(21))
-    pts_target_normalized = np.float32([[1-0.48203104734420776, 0.9063420295715332],
-                                        [1-0.6043621301651001, 0.8119394183158875],
-                                        [1-0.6763232946395874, 0.6790258884429932],
-                                        [1-0.7340714335441589, 0.5716733932495117],
-                                        [1-0.7896472215652466, 0.5098430514335632],
-                                        [1-0.5655680298805237, 0.5117031931877136],
-                                        [1-0.5979393720626831, 0.36575648188591003],
-                                        [1-0.6135331392288208, 0.2713503837585449],
-                                        [1-0.6196483373641968, 0.19251111149787903],
-                                        [1-0.4928809702396393, 0.4982593059539795],
-                                        [1-0.4899863600730896, 0.3213786780834198],
-                                        [1-0.4894656836986542, 0.21283167600631714],
-                                        [1-0.48334982991218567, 0.12900274991989136],
-                                        [1-0.4258815348148346, 0.5180916786193848],
-                                        [1-0.4033462107181549, 0.3581996262073517],
-                                        [1-0.3938145041465759, 0.2616880536079407],
-                                        [1-0.38608720898628235, 0.1775170862674713],
-                                        [1-0.36368662118911743, 0.5642163157463074],
-                                        [1-0.33553171157836914, 0.44737303256988525],
-                                        [1-0.3209102153778076, 0.3749568462371826],
-                                        [1-0.31213682889938354, 0.3026996850967407]])
-
-    mp_hands = mp.solutions.hands
-    with mp_hands.Hands(static_image_mode=True, max_num_hands=1, min_detection_confidence=0.5) as hands:
+# 7 landmark points (normalized)
+pts_index = list(range(21))
+pts_target_normalized = np.float32([[1-0.48203104734420776, 0.9063420295715332],
+                                    [1-0.6043621301651001, 0.8119394183158875],
+                                    [1-0.6763232946395874, 0.6790258884429932],
+                                    [1-0.7340714335441589, 0.5716733932495117],
+                                    [1-0.7896472215652466, 0.5098430514335632],
+                                    [1-0.5655680298805237, 0.5117031931877136],
+                                    [1-0.5979393720626831, 0.36575648188591003],
+                                    [1-0.6135331392288208, 0.2713503837585449],
+                                    [1-0.6196483373641968, 0.19251111149787903],
+                                    [1-0.4928809702396393, 0.4982593059539795],
+                                    [1-0.4899863600730896, 0.3213786780834198],
+                                    [1-0.4894656836986542, 0.21283167600631714],
+                                    [1-0.48334982991218567, 0.12900274991989136],
+                                    [1-0.4258815348148346, 0.5180916786193848],
+                                    [1-0.4033462107181549, 0.3581996262073517],
+                                    [1-0.3938145041465759, 0.2616880536079407],
+                                    [1-0.38608720898628235, 0.1775170862674713],
+                                    [1-0.36368662118911743, 0.5642163157463074],
+                                    [1-0.33553171157836914, 0.44737303256988525],
+                                    [1-0.3209102153778076, 0.3749568462371826],
+                                    [1-0.31213682889938354, 0.3026996850967407]])
+
+# MediaPipe Hands context used for every palm image
+# static_image_mode=False : tracking mode for video frames, the palm detector only runs when the tracked hand is lost
+def create_hands(static_image_mode=True):
+    return mp.solutions.hands.Hands(static_image_mode=static_image_mode, max_num_hands=1, min_detection_confidence=0.5)
+
+# use the given Hands context, or a temporary one if None
+def hands_context(hands=None):
+    return create_hands() if hands is None else nullcontext(hands)
+
+# find the hand landmarks of a BGR palm image (the image is flipped horizontally first)
+# hands : an opened Hands context to reuse
+# returns the (21,2) pixel coordinates of the landmarks in the flipped image, or None
+def find_landmarks(image, hands=None):
+    with hands_context(hands) as hands:
         # 1. Extract 21 landmark points
-        image = cv2.flip(cv2.imread(path_to_image), 1)
+        image = cv2.flip(image, 1)
         results = hands.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
         image_height, image_width, _ = image.shape
         if results.multi_hand_landmarks is None:
             return None
-        else:
-            hand_landmarks = results.multi_hand_landmarks[0]
-            # 2. Align images
-            pts = np.float32([[hand_landmarks.landmark[i].x*image_width,
+        hand_landmarks = results.multi_hand_landmarks[0]
+        return np.float32([[hand_landmarks.landmark[i].x*image_width,
                             hand_landmarks.landmark[i].y*image_height] for i in pts_index])
-            pts_target = np.float32([[x*image_width, y*image_height] for x,y in pts_target_normalized])
-            M, mask = cv2.findHomography(pts, pts_target, cv2.RANSAC,5.0)
-            warped_image = cv2.warpPerspective(image, M, (image_width, image_height), borderMode=cv2.BORDER_REPLICATE)
-            cv2.imwrite(path_to_warped_image, warped_image)
-            return WARP_SUCCESS
+
+# homography aligning the landmarks of find_landmarks with the reference hand
+def landmarks_homography(pts, image_width, image_height):
+    # 2. Align images
+    pts_target = np.float32([[x*image_width, y*image_height] for x,y in pts_target_normalized])
+    M, mask = cv2.findHomography(pts, pts_target, cv2.RANSAC,5.0)
+    return M
+
+# find the homography rectifying a BGR palm image (the image is flipped horizontally first)
+# hands : an opened Hands context to reuse
+# returns (M, landmarks) with landmarks the (21,2) pixel coordinates in the flipped image, or None
+def find_homography(image, hands=None):
+    pts = find_landmarks(image, hands)
+    if pts is None:
+        return None
+    image_height, image_width, _ = image.shape
+    return landmarks_homography(pts, image_width, image_height), pts
+
+# warp a BGR palm image with the homography found by find_homography
+def apply_homography(image, M):
+    image = cv2.flip(image, 1)
+    image_height, image_width, _ = image.shape
+    return cv2.warpPerspective(image, M, (image_width, image_height), borderMode=cv2.BORDER_REPLICATE)
+
+# project the landmarks found by find_homography into the warped image with M
+# returns (21,2) normalized (x, y), mirrored (x = 1 - x) like landmarks detected on the flipped warped image
+def warped_landmarks(M, landmarks, image_width, image_height):
+    pts = cv2.perspectiveTransform(np.float32(landmarks).reshape(-1, 1, 2), M).reshape(-1, 2)
+    return np.stack([1 - pts[:, 0] / image_width, pts[:, 1] / image_height], axis=1)
+
+# rectify a BGR palm image, returns (warped image, M, landmarks) or None
+def rectify_palm(image, hands=None):
+    found = find_homography(image, hands)
+    if found is None:
+        return None
+    M, landmarks = found
+    return apply_homography(image, M), M, landmarks
+
+# rectify a BGR palm image, returns the (flipped) warped image or None
+# hands : an opened Hands context to reuse
+def warp_palm(image, hands=None):
+    rectified = rectify_palm(image, hands)
+    if rectified is None:
+        return None
+    return rectified[0]
+
+def warp_image(path_to_image, path_to_warped_image):
+    warped_image = warp_palm(load_image(path_to_image))
+    if warped_image is None:
+        return None
+    cv2.imwrite(path_to_warped_image, warped_image)
+    return WARP_SUCCESS
     
 def warp(path_to_input_image, path_to_warped_image):
-    if path_to_input_image[-4:] in ['heic', 'HEIC']:
-        path_to_input_image = path_to_input_image[:-4] + 'jpg'
     warp_result = warp_image(path_to_input_image, path_to_warped_image)
     if warp_result is None:
         return None
@@ -0,0 +1,107 @@
+import os
+import json
+import threading
+import importlib.util
+from PIL import Image, ImageDraw, ImageFont
+
+#########################################################################################
+# Result rendering with PIL                                                             #
+# the annotated palm on the left, the title on top and the texts of the three lines    #
+# on the right, laid out in one pass on a single canvas (no matplotlib state)          #
+#########################################################################################
+
+TITLE = 'Kết quả xem Chỉ tay của bạn!'
+# header and color (RGB) of the heart, head and life line texts
+SECTIONS = [('Đường tình duyên', (220, 0, 0)), ('Đường trí tuệ', (0, 150, 0)), ('Đường sinh mệnh', (0, 0, 220))]
+FONT_SIZE = 14
+TITLE_FONT_SIZE = 18
+PANEL_WIDTH = 480
+MARGIN = 15
+
+# output formats of render_result (by file extension), 'json' writes the texts only
+FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'json': None}
+
+# TrueType fonts with Vietnamese glyphs, the first one found is used (PALM_FONT overrides)
+def font_paths():
+    paths = [os.environ.get('PALM_FONT'),
+             '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+             '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+             '/Library/Fonts/Arial Unicode.ttf',
+             'C:/Windows/Fonts/arial.ttf']
+    # DejaVuSans ships with matplotlib, found without importing it
+    spec = importlib.util.find_spec('matplotlib')
+    if spec is not None and spec.origin is not None:
+        paths.append(os.path.join(os.path.dirname(spec.origin), 'mpl-data', 'fonts', 'ttf', 'DejaVuSans.ttf'))
+    return [path for path in paths if path and os.path.exists(path)]
+
+# fonts are loaded once per thread, FreeType faces are not shared between threads
+local_fonts = threading.local()
+
+def get_font(size):
+    fonts = local_fonts.__dict__.setdefault('fonts', {})
+    if size not in fonts:
+        paths = font_paths()
+        fonts[size] = ImageFont.truetype(paths[0], size) if paths else ImageFont.load_default(size)
+    return fonts[size]
+
+# split text into lines no wider than width pixels
+def wrap_text(draw, text, font, width):
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = word if not line else line + ' ' + word
+            if line and draw.textlength(candidate, font=font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+# lay out the annotated palm im (PIL image) and the 6 texts of contents, returns an RGB PIL image
+def render_result(im, contents):
+    font = get_font(FONT_SIZE)
+    title_font = get_font(TITLE_FONT_SIZE)
+    line_height = int(FONT_SIZE * 1.4)
+    measure = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+    # (text, font, color) rows of the panel, None for a gap
+    rows = []
+    for (header, header_color), i in zip(SECTIONS, range(0, 6, 2)):
+        if rows:
+            rows.append(None)
+        rows.append((header, font, header_color))
+        for text in contents[i:i+2]:
+            rows += [(line, font, (0, 0, 0)) for line in wrap_text(measure, text, font, PANEL_WIDTH)]
+
+    title_height = int(TITLE_FONT_SIZE * 1.6)
+    panel_height = line_height * len(rows)
+    width = MARGIN + im.width + MARGIN + PANEL_WIDTH + MARGIN
+    height = MARGIN + title_height + max(im.height, panel_height) + MARGIN
+    canvas = Image.new('RGB', (width, height), (255, 255, 255))
+    canvas.paste(im.convert('RGB'), (MARGIN, MARGIN + title_height))
+
+    draw = ImageDraw.Draw(canvas)
+    title_width = draw.textlength(TITLE, font=title_font)
+    draw.text(((width - title_width) / 2, MARGIN), TITLE, font=title_font, fill=(0, 0, 0))
+    x, y = MARGIN + im.width + MARGIN, MARGIN + title_height
+    for row in rows:
+        if row is not None:
+            text, row_font, fill = row
+            draw.text((x, y), text, font=row_font, fill=fill)
+        y += line_height
+    return canvas
+
+# write the result to path, in the format of its extension (see FORMATS)
+# a .json path only gets the texts, nothing is rendered
+def write_result(im, contents, path):
+    ext = os.path.splitext(path)[1][1:].lower()
+    if ext not in FORMATS:
+        raise ValueError('unsupported result format: {}'.format(ext))
+    if FORMATS[ext] is None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'contents': contents}, f, ensure_ascii=False, indent=2)
+        return
+    options = {'quality': 90} if FORMATS[ext] in ('JPEG', 'WEBP') else {}
+    render_result(im, contents).save(path, FORMATS[ext], **options)
@@ -0,0 +1,293 @@
+import os
+import json
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+import cv2
+from tools import decode_image, clean_background, resize_image
+from rectification import rectify_palm, apply_homography, create_hands, warped_landmarks
+from detection import preprocess
+from classification import classify_image, scale_lines
+from measurement import measure_image
+from palm_reader import PalmResult, result_to_dict
+from session import PalmSession
+from cache import ResultCache, cache_key
+from metrics import MetricsRegistry, tracing, stage, add_count, merge
+
+#########################################################################################
+# HTTP serving mode                                                                     #
+# - POST /read with the image as body (raw bytes or multipart/form-data)                #
+#   => JSON with the three lines and their texts                                        #
+# - GET /health => JSON with the number of pending requests                             #
+# - GET /metrics => stage timings and counters in Prometheus text format                #
+# MediaPipe, skeletonization and classification run on a process pool,                  #
+# the UNet runs in this process on micro-batches of concurrent requests.                #
+#########################################################################################
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# Hands context of the current worker process, created once by init_worker
+hands = None
+
+def init_worker():
+    global hands
+    cv2.setNumThreads(1)
+    hands = create_hands()
+
+# worker functions also return the Trace of their stages, merged into the request's trace by the server
+
+# worker : decode and rectify, returns (network input of size detect_size, warped_mini, M, landmarks, landmarks projected into warped_mini)
+# or None if no palm is found
+def rectify_bytes(data, resize_value, detect_size):
+    with tracing() as trace:
+        with stage('decode'):
+            image = decode_image(data)
+        if image is None:
+            raise ValueError('cannot decode the uploaded image')
+        with stage('rectify'):
+            rectified = rectify_palm(image, hands)
+            if rectified is None:
+                return None, trace
+            warped, M, landmarks = rectified
+            img = preprocess(cv2.cvtColor(clean_background(warped), cv2.COLOR_BGR2RGB), detect_size)
+            mini_landmarks = warped_landmarks(M, landmarks, warped.shape[1], warped.shape[0])
+            return (img, resize_image(warped, resize_value), M, landmarks, mini_landmarks), trace
+
+# worker : classification and measurement from the detected line mask, returns (result dict, lines)
+def classify_and_measure(palmline_img, warped_mini, mini_landmarks):
+    with tracing() as trace:
+        with stage('classify'):
+            lines = classify_image(palmline_img)
+        with stage('measure'):
+            im, contents = measure_image(warped_mini, scale_lines(lines, palmline_img.shape[0], warped_mini.shape[0]), hands, mini_landmarks)
+    return (result_to_dict(PalmResult(None, None, warped_mini, palmline_img, lines, im, contents)), lines), trace
+
+# worker : measurement of a cached result (lines found at detect_size), only the homography is applied again
+def measure_cached(data, M, landmarks, lines, resize_value, detect_size):
+    with tracing() as trace:
+        with stage('rectify'):
+            warped = apply_homography(decode_image(data), M)
+            warped_mini = resize_image(warped, resize_value)
+        with stage('measure'):
+            im, contents = measure_image(warped_mini, scale_lines(lines, detect_size, resize_value), hands, warped_landmarks(M, landmarks, warped.shape[1], warped.shape[0]))
+    return result_to_dict(PalmResult(None, None, warped_mini, None, lines, im, contents)), trace
+
+# run a worker function on the pool and merge its trace into the current one
+async def run_traced(pool, fn, *args):
+    result, trace = await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    merge(trace)
+    return result
+
+class MicroBatcher:
+    """Gathers concurrent detection requests into batches for one UNet forward pass
+
+    a batch is run when it holds max_batch_size images or when its first image waited max_wait seconds
+    """
+
+    def __init__(self, session, max_batch_size=8, max_wait=0.01):
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        # one thread runs the net, so batches don't compete for the CPU
+        self.executor = ThreadPoolExecutor(1)
+
+    # returns the line mask of one preprocessed image
+    async def detect(self, img):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            imgs = [img for img, _ in batch]
+            try:
+                masks = await loop.run_in_executor(self.executor, self.session.detect, imgs)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), mask in zip(batch, masks):
+                if not future.done():
+                    future.set_result(mask)
+
+class PalmServer:
+    """asyncio HTTP server for the palm reading pipeline
+
+    max_pending : requests in progress beyond this are refused with 503 (backpressure)
+    max_body : largest accepted upload in bytes
+    cache : optional ResultCache, identical uploads then skip rectification, detection and classification
+    trace : add the stage timings and counters of each request to its JSON response
+    """
+
+    def __init__(self, session, workers=None, max_batch_size=8, max_wait=0.01, max_pending=64, max_body=20 * 1024 * 1024, cache=None, trace=False):
+        self.session = session
+        self.cache = cache
+        self.trace = trace
+        self.registry = MetricsRegistry()
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.pending = 0
+        self.batcher = MicroBatcher(session, max_batch_size, max_wait)
+        self.pool = ProcessPoolExecutor(workers or os.cpu_count(), multiprocessing.get_context('spawn'), init_worker)
+
+    # the cache hashing and disk I/O run on the default thread pool, off the event loop
+    async def read(self, data):
+        loop = asyncio.get_running_loop()
+        not_detected = 422, {'status': 'not_detected', 'error': 'Palm lines not properly detected! Please use another palm image.'}
+        if self.cache is not None:
+            with stage('cache_lookup'):
+                key = await loop.run_in_executor(None, cache_key, data, self.session)
+                entry = await loop.run_in_executor(None, self.cache.get, key)
+            add_count('cache_hits' if entry is not None else 'cache_misses')
+            if entry is not None:
+                if entry['M'] is None:
+                    return not_detected
+                result = await run_traced(self.pool, measure_cached, data, entry['M'], entry['landmarks'], entry['lines'], self.session.resize_value, self.session.detect_size)
+                return 200, dict(status='ok', **result)
+
+        rectified = await run_traced(self.pool, rectify_bytes, data, self.session.resize_value, self.session.detect_size)
+        if rectified is None:
+            if self.cache is not None:
+                await loop.run_in_executor(None, self.cache.put, key, {'M': None, 'landmarks': None, 'palmline_img': None, 'lines': [None, None, None]})
+            return not_detected
+        img, warped_mini, M, landmarks, mini_landmarks = rectified
+        with stage('detect'):
+            palmline_img = await self.batcher.detect(img)
+        result, lines = await run_traced(self.pool, classify_and_measure, palmline_img, warped_mini, mini_landmarks)
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, key, {'M': M, 'landmarks': landmarks, 'palmline_img': palmline_img, 'lines': lines})
+        return 200, dict(status='ok', **result)
+
+    async def route(self, method, path, headers, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'pending': self.pending}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.registry.prometheus_text()
+        if path != '/read':
+            return 404, {'status': 'error', 'error': 'not found'}
+        if method != 'POST':
+            return 405, {'status': 'error', 'error': 'use POST'}
+        # parsing a multipart body of several MB blocks, keep it off the event loop
+        data = await asyncio.get_running_loop().run_in_executor(None, upload_bytes, headers, body)
+        if not data:
+            return 400, {'status': 'error', 'error': 'empty upload'}
+        try:
+            with tracing(self.registry) as trace:
+                status, payload = await self.read(data)
+            if self.trace:
+                payload['trace'] = trace.to_dict()
+            return status, payload
+        except ValueError as e:
+            return 400, {'status': 'error', 'error': str(e)}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            path = target.split('?')[0]
+            # a /read request holds a pending slot from before its body is read until its response,
+            # the slot is checked and taken without an await in between so a burst can't overshoot
+            # max_pending, and a busy server refuses uploads without buffering them
+            counted = method == 'POST' and path == '/read'
+            if length > self.max_body:
+                status, payload = 413, {'status': 'error', 'error': 'upload too large'}
+            elif counted and self.pending >= self.max_pending:
+                status, payload = 503, {'status': 'error', 'error': 'server busy, retry later'}
+            else:
+                if counted:
+                    self.pending += 1
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.route(method, path, headers, body)
+                finally:
+                    if counted:
+                        self.pending -= 1
+        except (ValueError, asyncio.IncompleteReadError):
+            status, payload = 400, {'status': 'error', 'error': 'bad request'}
+        except Exception as e:
+            status, payload = 500, {'status': 'error', 'error': repr(e)}
+        # text payloads (metrics) are sent as they are, the others as JSON
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8'
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n'.format(status, STATUS_TEXT.get(status, ''), content_type, len(body))
+        if status == 503:
+            head += 'Retry-After: 1\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        batcher = asyncio.create_task(self.batcher.run())
+        print('serving on http://{}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+
+# image bytes of an upload : the first file of a multipart/form-data body, or the raw body
+def upload_bytes(headers, body):
+    content_type = headers.get('content-type', '')
+    if not content_type.startswith('multipart/form-data'):
+        return body
+    message = BytesParser(policy=HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    for part in message.iter_parts():
+        if part.get_filename() is not None or part.get_content_maintype() == 'image':
+            return part.get_payload(decode=True)
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve palm reading over HTTP, e.g. curl --data-binary @input/hand70.jpg http://127.0.0.1:8080/read')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint, a .onnx file (see onnx_export.py) is run without torch')
+    parser.add_argument('--backend', default='eager', help='UNet inference backend, see backend.py')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes for MediaPipe and classification')
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=10)
+    parser.add_argument('--max_pending', type=int, default=64)
+    parser.add_argument('--cache_mb', type=float, default=256, help='size of the in-memory result cache (0 = no cache)')
+    parser.add_argument('--cache_dir', default=None, help='on-disk result cache directory')
+    parser.add_argument('--trace', action='store_true', help='add the stage timings and counters to each response')
+    parser.add_argument('--detect_size', type=int, default=None, help='detect the lines at this size (e.g. 1024) with tiled inference')
+    parser.add_argument('--memory_limit_mb', type=float, default=512, help='UNet activation memory of one batch of tiles')
+    args = parser.parse_args()
+
+    session = PalmSession(args.model, backend=args.backend, detect_size=args.detect_size, memory_limit=int(args.memory_limit_mb * 1024 * 1024))
+    cache = ResultCache(int(args.cache_mb * 1024 * 1024), args.cache_dir) if args.cache_mb > 0 or args.cache_dir else None
+    server = PalmServer(session, args.workers, args.max_batch_size, args.max_wait_ms / 1000, args.max_pending, cache=cache, trace=args.trace)
+    asyncio.run(server.serve(args.host, args.port))
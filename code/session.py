@@ -0,0 +1,84 @@
+import glob
+import hashlib
+import numpy as np
+from rectification import create_hands
+from onnx_net import OnnxNet
+from detection import detect_batch, detect_tiled, TILE_MEMORY_LIMIT, LINE_THRESHOLD
+from classification import load_centers
+
+# short content hash of a file (the checkpoint version)
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+class PalmSession:
+    """Keeps the UNet and the MediaPipe Hands graph loaded, to be reused for every image of a process"""
+
+    # path_to_model : torch checkpoint (full or pruned, see model.load_unet),
+    #                 or .onnx file (see onnx_export.py) run with ONNX Runtime, torch is then never imported
+    # device : torch device (cpu by default)
+    # channels_last : keep the net (and its input batches) in NHWC memory format
+    # backend : one of backend.BACKENDS, see backend.py
+    # calibration : sample inputs for the int8 backend (the palms in input/ by default)
+    # detect_size : size of the line detection (e.g. 1024), tiled when larger than resize_value (see detection.detect_tiled),
+    #               the lines are then found on the larger mask and scaled down to resize_value for the measurement
+    # memory_limit : bytes of UNet activations a batch of tiles may use
+    # num_threads : threads of the net (torch or ONNX Runtime), their default if None
+    def __init__(self, path_to_model='checkpoint/checkpoint_aug_epoch70.pth', resize_value=256, device=None, warm_up=True, channels_last=False, backend='eager', calibration=None,
+                 detect_size=None, memory_limit=TILE_MEMORY_LIMIT, num_threads=None):
+        self.resize_value = resize_value
+        self.detect_size = detect_size or resize_value
+        self.memory_limit = memory_limit
+        self.device = device
+        self.channels_last = channels_last
+        self.backend = backend
+        self.model_version = file_hash(path_to_model)
+        # cluster centers of the line classification, loaded once (see train_centers.py)
+        self.centers_version = load_centers()[0]
+        if path_to_model.endswith('.onnx'):
+            self.backend = 'onnx'
+            self.net = OnnxNet(path_to_model, num_threads)
+        else:
+            self.load_torch(path_to_model, calibration, num_threads)
+        self.hands = create_hands()
+        if warm_up:
+            self.warm_up()
+
+    # load a torch checkpoint and prepare it for self.backend
+    def load_torch(self, path_to_model, calibration=None, num_threads=None):
+        import torch
+        from model import load_unet
+        from backend import prepare_backend, load_samples
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.device = self.device or torch.device('cpu')
+        net = load_unet(path_to_model, self.device)
+        net.to(self.device).eval()
+        if self.backend == 'int8' and calibration is None:
+            calibration = load_samples(glob.glob('input/*.jpg'), self.resize_value)
+        self.net = prepare_backend(net, self.backend, self.resize_value, calibration)
+        if self.channels_last and not isinstance(self.net, OnnxNet):
+            self.net.to(memory_format=torch.channels_last)
+
+    # line masks of N preprocessed palms (see detection.preprocess with self.detect_size)
+    def detect(self, imgs, threshold=LINE_THRESHOLD, return_probs=False):
+        if self.detect_size > self.resize_value:
+            return detect_tiled(self.net, imgs, self.device, self.channels_last, threshold, return_probs, memory_limit=self.memory_limit)
+        return detect_batch(self.net, imgs, self.device, self.channels_last, threshold, return_probs)
+
+    # run one dummy pass so the first request doesn't pay for graph and allocator setup
+    def warm_up(self):
+        self.detect([np.zeros((3, self.detect_size, self.detect_size), dtype=np.float32)])
+        self.hands.process(np.zeros((self.resize_value, self.resize_value, 3), dtype=np.uint8))
+
+    def close(self):
+        self.hands.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
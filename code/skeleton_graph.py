@@ -0,0 +1,78 @@
+import numpy as np
+
+class SkeletonGraph:
+    """Graph of a skeleton image in compressed sparse row (CSR) form
+
+    nodes : (N,2) int16 array of node coordinates (y, x), end points and intersections
+    indptr, adj_node, adj_edge : CSR adjacency, the adjacent nodes of node i are
+        adj_node[indptr[i]:indptr[i+1]], reached through the edges adj_edge[indptr[i]:indptr[i+1]]
+        an edge walked in reverse is stored as ~edge (negative)
+    pixels : (P,4) int16 buffer of [y, x, dy, dx] shared by all edges
+    edge_ptr : edge e covers pixels[edge_ptr[e]:edge_ptr[e+1]], from its first node to its second
+    """
+
+    # nodes : list of (y, x) nodes, in traversal order
+    def __init__(self, nodes):
+        self.nodes = np.array(nodes, dtype=np.int16).reshape(-1, 2)
+        self.node_index = {node: i for i, node in enumerate(nodes)}
+        # while building : adjacent node index -> edge for each node, and flat pixel runs of edges
+        self.adj = [dict() for _ in nodes]
+        self.run_pixels = []
+        self.run_ptr = [0]
+
+    # add the line between two nodes, pixels : [[y, x, dy, dx], ...] from one node to the other
+    # a later edge between the same nodes replaces the earlier one
+    def add_edge(self, pixels):
+        start = self.node_index[tuple(pixels[0][:2])]
+        end = self.node_index[tuple(pixels[-1][:2])]
+        edge = len(self.run_ptr) - 1
+        self.run_pixels.extend(pixels)
+        self.run_ptr.append(len(self.run_pixels))
+        self.adj[start][end] = edge
+        self.adj[end][start] = ~edge
+
+    # pack the edges into the CSR arrays and the shared pixel buffer (replaced edges are dropped)
+    def freeze(self):
+        run_pixels = np.array(self.run_pixels, dtype=np.int16).reshape(-1, 4)
+        run_ptr = np.array(self.run_ptr)
+        live = sorted({edge if edge >= 0 else ~edge for adj in self.adj for edge in adj.values()})
+        new_edge = {edge: i for i, edge in enumerate(live)}
+
+        lengths = run_ptr[1:][live] - run_ptr[:-1][live] if live else np.zeros(0, dtype=int)
+        self.edge_ptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int32)
+        if live:
+            index = np.concatenate([np.arange(run_ptr[edge], run_ptr[edge + 1]) for edge in live])
+            self.pixels = run_pixels[index]
+        else:
+            self.pixels = np.zeros((0, 4), dtype=np.int16)
+
+        self.indptr = np.concatenate(([0], np.cumsum([len(adj) for adj in self.adj]))).astype(np.int32)
+        self.adj_node = np.array([node for adj in self.adj for node in adj], dtype=np.int32)
+        self.adj_edge = np.array([new_edge[edge] if edge >= 0 else ~new_edge[~edge] for adj in self.adj for edge in adj.values()], dtype=np.int32)
+        del self.adj, self.run_pixels, self.run_ptr
+        return self
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_ptr) - 1
+
+    # number of pixels of an edge
+    def edge_length(self, edge):
+        if edge < 0:
+            edge = ~edge
+        return int(self.edge_ptr[edge + 1] - self.edge_ptr[edge])
+
+    # pixels of an edge (a view of the shared buffer, reversed for ~edge)
+    def edge_pixels(self, edge):
+        if edge < 0:
+            edge = ~edge
+            return self.pixels[self.edge_ptr[edge]:self.edge_ptr[edge + 1]][::-1]
+        return self.pixels[self.edge_ptr[edge]:self.edge_ptr[edge + 1]]
+
+    # pixels of a line walked through the given edges, as one (L,4) int16 array
+    def line_pixels(self, edges):
+        return np.concatenate([self.edge_pixels(edge) for edge in edges])
@@ -0,0 +1,178 @@
+import sys
+import json
+import time
+import argparse
+from collections import namedtuple
+import numpy as np
+import cv2
+from tools import fit_image, clean_background, WORKING_SIZE
+from rectification import create_hands, find_landmarks, landmarks_homography, apply_homography
+from detection import preprocess, LINE_THRESHOLD
+from palm_reader import PalmReader, result_to_dict
+from session import PalmSession
+from metrics import stage, add_count, tracing, MetricsRegistry, NO_TRACE
+
+#########################################################################################
+# Streaming mode for videos and live cameras                                            #
+# - MediaPipe Hands runs in tracking mode on every frame (cheap once the hand is found) #
+# - the homography is computed again only when the hand moved more than                 #
+#   motion_threshold since the last one, otherwise the previous one is reused           #
+# - detection and classification run again only when the warped palm changed more     #
+#   than change_threshold since the last detection                                      #
+# - the line probability maps are averaged over time (exponential moving average), so  #
+#   the lines don't flicker from one detection to the next                              #
+# - results are yielded frame by frame by a generator                                   #
+#########################################################################################
+
+# result of one frame
+# index, time : frame number and timestamp (seconds) in the stream
+# result : PalmResult of the latest detection (None while no hand is found)
+# detected : detection and classification ran on this frame, rectified : the homography was computed on this frame
+StreamResult = namedtuple('StreamResult', ['index', 'time', 'result', 'detected', 'rectified'])
+
+# side of the grayscale thumbnails compared to decide if the warped palm changed
+THUMBNAIL_SIZE = 64
+
+# (time in seconds, BGR frame) of a video file or a camera (an int index), frames are fitted to max_size
+def video_frames(source, max_size=WORKING_SIZE):
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError('cannot open the video source {}'.format(source))
+    start = time.perf_counter()
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            # cameras have no position in the stream, their frames are timed on arrival
+            position = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000 if isinstance(source, str) else time.perf_counter() - start
+            yield position, fit_image(frame, max_size)
+    finally:
+        capture.release()
+
+# mean displacement of the landmarks relative to the image size
+def landmark_motion(landmarks, reference, image_width, image_height):
+    return float(np.mean(np.linalg.norm((landmarks - reference) / [image_width, image_height], axis=1)))
+
+def thumbnail(warped):
+    return cv2.resize(cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY), (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+class PalmStream:
+    """Reads the palm of a stream of frames, reusing the homography and the lines of the previous frames
+
+    motion_threshold : landmark displacement (fraction of the frame size) above which the homography is computed again
+    change_threshold : mean absolute difference (0-255) of the warped palm thumbnails above which the lines are detected again
+    smoothing : weight of the newest line probability map in the moving average (1 = no smoothing)
+    """
+
+    def __init__(self, session, motion_threshold=0.02, change_threshold=6.0, smoothing=0.5):
+        self.session = session
+        self.reader = PalmReader(session, saved=[])
+        self.motion_threshold = motion_threshold
+        self.change_threshold = change_threshold
+        self.smoothing = smoothing
+        # line probability above which a pixel is a line, the same as LINE_THRESHOLD on the logits
+        self.probability_threshold = 1 / (1 + np.exp(-LINE_THRESHOLD))
+        self.hands = create_hands(static_image_mode=False)
+        self.reset()
+
+    # forget the tracked hand (e.g. when it leaves the frame)
+    def reset(self):
+        self.M = None
+        self.landmarks = None
+        self.thumbnail = None
+        self.probs = None
+        self.result = None
+
+    # read one BGR frame, returns StreamResult
+    def process(self, frame, index=0, timestamp=0.0):
+        add_count('stream_frames')
+        with stage('track'):
+            landmarks = find_landmarks(frame, self.hands)
+        if landmarks is None:
+            self.reset()
+            return StreamResult(index, timestamp, None, False, False)
+
+        image_height, image_width, _ = frame.shape
+        rectified = self.M is None or landmark_motion(landmarks, self.landmarks, image_width, image_height) > self.motion_threshold
+        if rectified:
+            with stage('homography'):
+                self.M, self.landmarks = landmarks_homography(landmarks, image_width, image_height), landmarks
+            # no homography for these landmarks (cv2.findHomography failed) : same as a lost hand
+            if self.M is None:
+                self.reset()
+                return StreamResult(index, timestamp, None, False, False)
+        else:
+            add_count('homography_reused')
+        with stage('warp'):
+            warped = apply_homography(frame, self.M)
+            warped_thumbnail = thumbnail(warped)
+
+        if self.thumbnail is not None and np.abs(warped_thumbnail - self.thumbnail).mean() <= self.change_threshold:
+            add_count('detection_skipped')
+            return StreamResult(index, timestamp, self.result, False, rectified)
+
+        # detection, smoothing of the line probabilities, then classification and measurement of the smoothed mask
+        self.thumbnail = warped_thumbnail
+        with stage('detect'):
+            img = preprocess(cv2.cvtColor(clean_background(warped), cv2.COLOR_BGR2RGB), self.session.detect_size)
+            probs = self.session.detect([img], return_probs=True)[1][0].astype(np.float32)
+        self.probs = probs if self.probs is None else self.smoothing * probs + (1 - self.smoothing) * self.probs
+        artifacts = self.reader.artifacts(frame)
+        artifacts.put('homography', (self.M, self.landmarks))
+        artifacts.put('warped', warped)
+        artifacts.put('palmline_img', (self.probs > self.probability_threshold).astype(np.uint8) * 255)
+        self.result = self.reader.finish(artifacts)
+        return StreamResult(index, timestamp, self.result, True, rectified)
+
+    # frames : iterable of (time, BGR frame), e.g. video_frames
+    # registry : optional MetricsRegistry, each frame is traced on its own and aggregated into it
+    # yields a StreamResult for each frame as soon as it is read
+    def read(self, frames, registry=None):
+        for index, (timestamp, frame) in enumerate(frames):
+            with tracing(registry) if registry is not None else NO_TRACE:
+                result = self.process(frame, index, timestamp)
+            yield result
+
+    def close(self):
+        self.hands.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='read palms continuously from a video file or a camera')
+    parser.add_argument('--input', required=True, help='video file, or camera index (e.g. 0)')
+    parser.add_argument('--model', default='checkpoint/checkpoint_aug_epoch70.pth', help='the path to the checkpoint (or .onnx, see onnx_export.py)')
+    parser.add_argument('--backend', default='eager', help='UNet inference backend, see backend.py')
+    parser.add_argument('--motion_threshold', type=float, default=0.02, help='hand displacement (fraction of the frame) that triggers a new homography')
+    parser.add_argument('--change_threshold', type=float, default=6.0, help='change of the warped palm (mean absolute difference, 0-255) that triggers a new detection')
+    parser.add_argument('--smoothing', type=float, default=0.5, help='weight of the newest detection in the moving average of the line probabilities')
+    parser.add_argument('--jsonl', default=None, help='append a record for every new detection to this file (stdout if not given)')
+    parser.add_argument('--trace', action='store_true', help='print the stage timings and counters aggregated over the frames at the end (Prometheus text format)')
+    args = parser.parse_args()
+
+    source = int(args.input) if args.input.isdigit() else args.input
+    output = open(args.jsonl, 'a', encoding='utf-8') if args.jsonl is not None else sys.stdout
+    start = time.perf_counter()
+    num_frames = num_detections = 0
+    # a live stream has no end, so the frames are aggregated instead of kept in one trace
+    registry = MetricsRegistry() if args.trace else None
+    with PalmSession(args.model, backend=args.backend) as session, \
+            PalmStream(session, args.motion_threshold, args.change_threshold, args.smoothing) as stream:
+        for frame in stream.read(video_frames(source), registry):
+            num_frames += 1
+            if frame.detected:
+                num_detections += 1
+                record = dict(frame=frame.index, time=round(frame.time, 3), **result_to_dict(frame.result)) if frame.result is not None else {'frame': frame.index, 'status': 'not_detected'}
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                output.flush()
+    if output is not sys.stdout:
+        output.close()
+    seconds = time.perf_counter() - start
+    print('{} frames in {:.1f}s ({:.1f} fps), {} detections'.format(num_frames, seconds, num_frames / seconds if seconds else 0, num_detections), file=sys.stderr)
+    if registry is not None:
+        print(registry.prometheus_text(), file=sys.stderr)
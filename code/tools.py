@@ -1,19 +1,62 @@
+import io
 import numpy as np
-from PIL import Image
-import matplotlib.pyplot as plt
+from PIL import Image, ImageOps
 import cv2
 from pillow_heif import register_heif_opener
+from render import write_result
 
 def heic_to_jpeg(heic_dir, jpeg_dir):
     register_heif_opener()  
     image = Image.open(heic_dir)
     image.save(jpeg_dir, "JPEG")
 
-def remove_background(jpeg_dir, path_to_clean_image):
-    if jpeg_dir[-4:] in ['heic', 'HEIC']:
-        heic_to_jpeg(jpeg_dir, jpeg_dir[:-4] + 'jpg')
-        jpeg_dir = jpeg_dir[:-4] + 'jpg'
-    img = cv2.imread(jpeg_dir)
+# longest side (pixels) inputs are decoded to, big enough for hand landmarks and warping
+# (the UNet only sees resize_value x resize_value), None keeps the full resolution
+WORKING_SIZE = 1024
+
+# OpenCV flags decoding a jpeg at 1/8, 1/4 or 1/2 of its size (DCT scaling, no full-size buffer)
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# decode image bytes (jpeg, png, heic, ...) once, in memory, as BGR array, None if they are not an image
+# - the EXIF orientation is applied
+# - jpeg is decoded at the smallest DCT scale whose longest side is still >= max_size
+# - the longest side is then downscaled to max_size
+def decode_image(data, max_size=WORKING_SIZE):
+    flag = cv2.IMREAD_COLOR
+    if max_size is not None:
+        try:
+            header = Image.open(io.BytesIO(data))  # reads the header only
+            if header.format == 'JPEG':
+                flag = next((reduced for factor, reduced in REDUCED_FLAGS if max(header.size) // factor >= max_size), flag)
+        except Exception:
+            pass
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        # heic and other formats OpenCV can't read
+        register_heif_opener()
+        try:
+            img = cv2.cvtColor(np.asarray(ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')), cv2.COLOR_RGB2BGR)
+        except Exception:
+            return None
+    return fit_image(img, max_size)
+
+# downscale an image so that its longest side is at most max_size
+def fit_image(img, max_size):
+    if max_size is None or max(img.shape[:2]) <= max_size:
+        return img
+    scale = max_size / max(img.shape[:2])
+    # area averaging only matters for large factors, bilinear is much faster below 2x
+    interpolation = cv2.INTER_AREA if scale < 0.5 else cv2.INTER_LINEAR
+    return cv2.resize(img, (round(img.shape[1] * scale), round(img.shape[0] * scale)), interpolation=interpolation)
+
+# load an image file (jpeg, png, heic, ...) as BGR array, see decode_image
+def load_image(path_to_image, max_size=WORKING_SIZE):
+    with open(path_to_image, 'rb') as f:
+        return decode_image(f.read(), max_size)
+
+# whiten everything but the skin-colored region of a BGR image
+def clean_background(img):
+    img = img.copy()
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     lower = np.array([0, 20, 80], dtype="uint8")
     upper = np.array([50, 255, 255], dtype="uint8")
@@ -23,7 +66,14 @@ def remove_background(jpeg_dir, path_to_clean_image):
     filter = g.copy()
     ret, mask = cv2.threshold(filter, 10, 255, 1)
     img[mask == 255] = 255
-    cv2.imwrite(path_to_clean_image, img)
+    return img
+
+def remove_background(jpeg_dir, path_to_clean_image):
+    cv2.imwrite(path_to_clean_image, clean_background(load_image(jpeg_dir)))
+
+# nearest-neighbor resize of an image array (same sampling as PIL)
+def resize_image(img, resize_value):
+    return np.asarray(Image.fromarray(img).resize((resize_value, resize_value), resample=Image.NEAREST))
 
 def resize(path_to_warped_image, path_to_warped_image_clean, path_to_warped_image_mini, path_to_warped_image_clean_mini, resize_value):
     pil_img = Image.open(path_to_warped_image)
@@ -31,36 +81,13 @@ def resize(path_to_warped_image, path_to_warped_image_clean, path_to_warped_imag
     pil_img.resize((resize_value, resize_value), resample=Image.NEAREST).save(path_to_warped_image_mini)
     pil_img_clean.resize((resize_value, resize_value), resample=Image.NEAREST).save(path_to_warped_image_clean_mini)
 
+# write the annotated palm and the texts of each line to path_to_result
+# the format follows the extension (.jpg, .png, .webp, or .json for the texts only), see render.py
 def save_result(im, contents, resize_value, path_to_result):
     if im is None:
         print_error()
     else:
-        heart_content_1, heart_content_2, head_content_1, head_content_2, life_content_1, life_content_2 = contents
-        image_height, image_width = im.size
-        fontsize = 12
-        
-        plt.tick_params(
-            axis='both',          # changes apply to the x-axis
-            which='both',      # both major and minor ticks are affected
-            bottom=False,      # ticks along the bottom edge are off
-            left=False,         # ticks along the top edge are off
-            labelbottom=False,
-            labelleft=False
-        )
-        plt.title('Kết quả xem Chỉ tay của bạn!', fontsize=14, y=1.01)
-
-        plt.text(image_width + 15, 15, "Đường tình duyên", color='r', fontsize=fontsize)
-        plt.text(image_width + 15, 35, heart_content_1, fontsize=fontsize)
-        plt.text(image_width + 15, 55, heart_content_2, fontsize=fontsize)
-        plt.text(image_width + 15, 80, "Đường trí tuệ", color='g', fontsize=fontsize)
-        plt.text(image_width + 15, 100, head_content_1, fontsize=fontsize)
-        plt.text(image_width + 15, 120, head_content_2, fontsize=fontsize)
-        plt.text(image_width + 15, 145, "Đường sinh mệnh", color='b', fontsize=fontsize)
-        plt.text(image_width + 15, 165, life_content_1, fontsize=fontsize)
-        plt.text(image_width + 15, 185, life_content_2, fontsize=fontsize)
-    
-        plt.imshow(im)
-        plt.savefig(path_to_result, bbox_inches = "tight")
+        write_result(im, contents, path_to_result)
 
 def print_error():
     print('Palm lines not properly detected! Please use another palm image.')
\ No newline at end of file
@@ -0,0 +1,155 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import multiprocessing
+import numpy as np
+import cv2
+from skimage.morphology import skeletonize
+from classification import group, extract_features, CENTERS_PATH
+
+#########################################################################################
+# Cluster center training                                                              #
+# (1) line features of a rectified corpus are streamed to a float32 file on disk,      #
+#     masks are processed in parallel, one shard (or chunk of images) per task         #
+# (2) mini-batch k-means (k=3) on random batches read from the memory-mapped features, #
+#     the restarts run in parallel and the one with the lowest inertia is kept         #
+# (3) the centers are sorted by max_y (heart, head, life) and saved with a version     #
+#     to CENTERS_PATH, which classification.get_cluster_centers loads                  #
+#########################################################################################
+
+NUM_FEATURES = 24
+
+# line features of one line mask (nonzero pixels are lines), (n,24) float32 without nan rows
+def mask_features(mask):
+    skel_img = (skeletonize(mask > 0) * 255).astype(np.uint8)
+    features = extract_features(group(skel_img), mask.shape[0], mask.shape[1]).astype(np.float32)
+    return features[np.isfinite(features).all(axis=1)]
+
+# worker : features of a task, ('shard', path of a prepare_dataset.py shard) or ('images', [mask paths])
+def task_features(task):
+    kind, source = task
+    features = [np.empty((0, NUM_FEATURES), dtype=np.float32)]
+    if kind == 'shard':
+        with np.load(source) as shard:
+            for mask in shard['masks']:
+                features.append(mask_features(mask))
+    else:
+        for path in source:
+            mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if mask is not None:
+                features.append(mask_features(mask))
+    return np.concatenate(features)
+
+# stream the features of all masks to path_to_features (raw float32 rows), returns the number of rows
+# dataset_dir : shards written by prepare_dataset.py, mask_glob : line mask images (e.g. 'line_sample/*.png')
+def extract_corpus_features(path_to_features, dataset_dir=None, mask_glob=None, workers=None, chunk_size=64):
+    tasks = []
+    if dataset_dir is not None:
+        tasks += [('shard', path) for path in sorted(glob.glob(os.path.join(dataset_dir, 'shard_*.npz')))]
+    if mask_glob is not None:
+        paths = sorted(glob.glob(mask_glob))
+        tasks += [('images', paths[i:i+chunk_size]) for i in range(0, len(paths), chunk_size)]
+
+    num_rows = 0
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers or os.cpu_count()) as pool, open(path_to_features, 'wb') as f:
+        for num_done, features in enumerate(pool.imap_unordered(task_features, tasks), 1):
+            f.write(features.tobytes())
+            num_rows += len(features)
+            print('[{}/{}] {} line features'.format(num_done, len(tasks), num_rows), file=sys.stderr)
+    return num_rows
+
+def open_features(path_to_features):
+    return np.memmap(path_to_features, dtype=np.float32, mode='r').reshape(-1, NUM_FEATURES)
+
+# index of the nearest center of each row
+def nearest_center(data, centers):
+    distances = ((data[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1), distances.min(axis=1)
+
+# k-means++ seeding on a sample
+def kmeans_plus_plus(sample, k, rng):
+    centers = [sample[rng.integers(len(sample))]]
+    for _ in range(1, k):
+        _, distances = nearest_center(sample, np.array(centers))
+        centers.append(sample[rng.choice(len(sample), p=distances / distances.sum())])
+    return np.array(centers, dtype=np.float64)
+
+# random rows of the memory-mapped features (sorted indices, for sequential reads)
+def sample_rows(features, size, rng):
+    return np.asarray(features[np.sort(rng.integers(0, len(features), size))], dtype=np.float64)
+
+# worker : one mini-batch k-means run (Sculley 2010), returns (inertia, centers)
+# the inertia is measured on the same evaluation sample for every seed, so runs are comparable
+def minibatch_kmeans(args):
+    path_to_features, k, batch_size, iterations, seed = args
+    features = open_features(path_to_features)
+    rng = np.random.default_rng(seed)
+    centers = kmeans_plus_plus(sample_rows(features, 10 * batch_size, rng), k, rng)
+    counts = np.zeros(k)
+    for _ in range(iterations):
+        batch = sample_rows(features, batch_size, rng)
+        labels, _ = nearest_center(batch, centers)
+        for j in range(k):
+            members = batch[labels == j]
+            if len(members) == 0: continue
+            # per-center learning rate 1/count : each center is the running mean of its samples
+            counts[j] += len(members)
+            centers[j] += (members.sum(axis=0) - len(members) * centers[j]) / counts[j]
+    evaluation = sample_rows(features, 10 * batch_size, np.random.default_rng(0))
+    return float(nearest_center(evaluation, centers)[1].mean()), centers
+
+# run the restarts in parallel, returns (inertia, centers sorted by max_y) of the best one
+def train_centers(path_to_features, k=3, batch_size=4096, iterations=200, restarts=8, workers=None, seed=0):
+    tasks = [(path_to_features, k, batch_size, iterations, seed + i) for i in range(restarts)]
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(workers or os.cpu_count(), restarts)) as pool:
+        runs = pool.map(minibatch_kmeans, tasks)
+    inertia, centers = min(runs, key=lambda run: run[0])
+    return inertia, centers[np.argsort(centers[:, 2])].astype(np.float32)
+
+# save the centers with a version (date + content hash), also kept as centers-<version>.npz next to path
+def save_centers(centers, path=CENTERS_PATH, num_features=None, inertia=None):
+    digest = hashlib.sha256(centers.tobytes()).hexdigest()[:8]
+    version = '{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), digest)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    meta = json.dumps({'num_features': num_features, 'inertia': inertia})
+    for target in [os.path.splitext(path)[0] + '-' + version + '.npz', path]:
+        with open(target + '.tmp', 'wb') as f:
+            np.savez(f, centers=centers, version=version, meta=meta)
+        os.replace(target + '.tmp', target)
+    return version
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='train the line cluster centers used by classification.py')
+    parser.add_argument('--dataset_dir', default=None, help='rectified masks written by prepare_dataset.py')
+    parser.add_argument('--mask_glob', default=None, help="rectified line mask images, e.g. 'line_sample/*.png'")
+    parser.add_argument('--features', default='line_features.f32', help='feature file, reused unless --refresh')
+    parser.add_argument('--refresh', action='store_true', help='extract the features again')
+    parser.add_argument('--output', default=CENTERS_PATH)
+    parser.add_argument('--batch_size', type=int, default=4096)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--restarts', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.refresh or not os.path.exists(args.features):
+        if args.dataset_dir is None and args.mask_glob is None:
+            parser.error('--dataset_dir or --mask_glob is needed to extract the features')
+        start = time.perf_counter()
+        num_rows = extract_corpus_features(args.features, args.dataset_dir, args.mask_glob, args.workers)
+        print('{} line features in {:.1f}s'.format(num_rows, time.perf_counter() - start))
+    num_features = len(open_features(args.features))
+    if num_features < 3:
+        sys.exit('not enough line features to train')
+
+    start = time.perf_counter()
+    inertia, centers = train_centers(args.features, 3, args.batch_size, args.iterations, args.restarts, args.workers, args.seed)
+    version = save_centers(centers, args.output, num_features, inertia)
+    print('centers {} (inertia {:.4f}, {} restarts in {:.1f}s) saved to {}'.format(version, inertia, args.restarts, time.perf_counter() - start, args.output))